@@ -26,19 +26,115 @@
 
 from threading import RLock
 import minqlx
+import atexit
 import random
 import re
 import threading
 import datetime
 import http.client
 import json
+import os
 import traceback
+import urllib.parse
+import bisect
+import collections
+import heapq
+import itertools
+import queue
+import time
+from array import array
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 
 ELO_GAMETYPES = ("ca", "ffa", "ctf", "duel", "tdm")
 _rating_key = "minqlx:players:{}:rating"
 _rating_gametype_key = "minqlx:players:{}:rating:{}"
 _quakelive_key = "minqlx:players:{}:old_quakelive_nick"
+# Hash of everything balance stores about a player: a field per gametype with the
+# rating, "nick" with the old quakelive nick and "migrated" once the keys above
+# have been moved into it. See read_profiles() and cmd_migrateratings().
+_profile_key = "minqlx:players:{}:balance"
+# Set once a !migrateratings ran to the end, after which no old keys are left to read.
+_profiles_migrated_key = "minqlx:balance:profiles_migrated"
+_qlranks_failed_key = "minqlx:balance:qlranks_failed:{}"
+# Hash of gametype -> rating for a nick, read by the "redis" rating provider.
+_provider_key = "minqlx:balance:provider:{}"
+# Games counted towards a player's local rating.
+_games_key = "minqlx:players:{}:games:{}"
+
+# Up to this many players the partition search is exact, above it we fall
+# back to a greedy split refined by swaps for at most PARTITION_TIME_BUDGET seconds.
+EXACT_PARTITION_LIMIT = 16
+PARTITION_TIME_BUDGET = 0.005
+
+# Team exchanges searched for suggestions as (players from red, players from blue).
+# Always as many each way, since !teams only makes suggestions for even teams.
+EXCHANGE_SIZES = ((1, 1), (2, 2))
+
+# Seconds connecting players are collected for before their ratings are fetched together.
+CONNECT_COALESCE_WINDOW = 1
+
+# Trace levels. A subsystem keeps the messages at or below its level, none by default.
+TRACE_OFF = 0
+TRACE_INFO = 1
+TRACE_DEBUG = 2
+TRACE_LEVELS = {"off": TRACE_OFF, "info": TRACE_INFO, "debug": TRACE_DEBUG}
+TRACE_SUBSYSTEMS = ("hooks", "commands", "rating", "lookup", "balance", "requirements")
+TRACE_BUFFER_SIZE = 500
+
+# Latency samples kept for each stage of getting a rating, see LatencyStats.
+LATENCY_SAMPLES = 500
+LATENCY_STAGES = ("connect_to_rating", "coalesce", "db", "name_wait", "queue", "http", "handback", "lookup")
+
+# Worker threads running QLRanks lookups, and how many lookups may wait for a free one.
+LOOKUP_WORKERS = 2
+LOOKUP_QUEUE_SIZE = 16
+
+# Seconds between flushes of queued database writes, and the most keys written per batch.
+WRITE_BEHIND_INTERVAL = 2
+WRITE_BEHIND_BATCH = 100
+
+# QLRanks is considered down once at least CIRCUIT_MIN_REQUESTS of the last CIRCUIT_WINDOW
+# requests were made and CIRCUIT_FAILURE_RATE of them failed. We then wait CIRCUIT_BACKOFF
+# seconds before letting a single probe through, doubling up to CIRCUIT_MAX_BACKOFF every
+# time the probe fails.
+CIRCUIT_WINDOW = 10
+CIRCUIT_MIN_REQUESTS = 4
+CIRCUIT_FAILURE_RATE = 0.5
+CIRCUIT_BACKOFF = 15
+CIRCUIT_MAX_BACKOFF = 600
+
+# Seconds an unanswered lookup is remembered for. Well past the 10 second HTTP timeout.
+LOOKUP_TTL = 120
+# Seconds to wait for a connecting player's name before giving them the default rating.
+NAME_WAIT_TIMEOUT = 20
+
+# Seconds between ticks of the scheduler for rating requirement tells and kicks.
+REQUIREMENTS_TICK = 1
+TIMER_WHEEL_SLOTS = 64
+# Seconds a tell waits for the player to finish loading before it's dropped.
+NOTIFY_TIMEOUT = 20
+# Seconds until a kickbanned player is kicked, from connecting and from being told.
+KICK_DELAY = 40
+KICK_AFTER_TELL = 20
+
+# Seconds after a round countdown during which an agreed switch is executed right away.
+AGREE_WINDOW = 4
+
+# Players converted per round trip by !migrateratings.
+MIGRATION_BATCH = 100
+
+# Local ratings, see rate_result(). Players with fewer than ELO_PROVISIONAL_GAMES
+# rated games move faster, and a round counts for ELO_ROUND_WEIGHT of a game.
+LOCAL_RATING_GAMETYPES = ("ca", "ctf", "tdm")
+ELO_K = 32
+ELO_PROVISIONAL_K = 96
+ELO_PROVISIONAL_GAMES = 10
+ELO_ROUND_WEIGHT = 0.1
 
 class balance(minqlx.Plugin):
     def __init__(self):
@@ -47,14 +143,18 @@ class balance(minqlx.Plugin):
         self.add_hook("player_connect", self.handle_player_connect)
         self.add_hook("player_disconnect", self.handle_player_disconnect)
         self.add_hook("player_loaded", self.handle_player_loaded)
+        self.add_hook("userinfo", self.handle_userinfo)
         self.add_hook("team_switch", self.handle_team_switch)
         self.add_hook("round_countdown", self.handle_round_countdown)
         self.add_hook("game_end", self.handle_game_end)
+        self.add_hook("round_end", self.handle_round_end)
+        self.add_hook("unload", self.handle_unload)
         
         self.add_command(("teams", "teens"), self.cmd_teams)
         self.add_command("balance", self.cmd_balance, 1)
         self.add_command("do", self.cmd_do, 1)
         self.add_command(("agree", "a"), self.cmd_agree)
+        self.add_command(("decline", "refuse"), self.cmd_decline)
         self.add_command("setnickfor", self.cmd_setnickfor, 3, usage="<id> <nick> or <id> to delete")
         self.add_command(("ranknick","oldnick","nick","iam"), self.cmd_setnick, 0, usage="<nick>")
         self.add_command(("qlnick","getnick","shownick","whoami"), self.cmd_getnick, 0)
@@ -64,6 +164,10 @@ class balance(minqlx.Plugin):
         self.add_command(("remrating", "remelo"), self.cmd_remrating, 3, usage="<id>")
         
         self.add_command(("ratinginfo"), self.cmd_ratinginfo, 5)
+        self.add_command("trace", self.cmd_trace, 5, usage="<subsystem|all> <off|info|debug> [sample]")
+        self.add_command("tracedump", self.cmd_tracedump, 5, usage="[lines]")
+        self.add_command("ratingstats", self.cmd_ratingstats, 5, usage="[json]")
+        self.add_command("migrateratings", self.cmd_migrateratings, 5)
 
         self.set_cvar_once("qlx_balance_vetounevenshuffle", "1")
         self.set_cvar_once("qlx_balance_autobalance", "1")
@@ -73,57 +177,134 @@ class balance(minqlx.Plugin):
         
         self.set_cvar_once("qlx_balance_allowspectators", "1")
         self.set_cvar_once("qlx_balance_minimumsuggestiondifference", "25")
+        self.set_cvar_once("qlx_balance_suggestions", "3")
+        # Time budget in milliseconds for each team search. !teams and !balance run theirs
+        # on a worker thread, see search_plans().
+        self.set_cvar_once("qlx_balance_searchtime", "5")
+        # Size and lifetime in seconds of the in-memory rating and nick caches.
+        self.set_cvar_once("qlx_balance_cachesize", "4096")
+        self.set_cvar_once("qlx_balance_cachettl", "43200")
+        # Seconds a nick QLRanks had no rating for is remembered in the database.
+        self.set_cvar_once("qlx_balance_failedlookupttl", "604800")
+        # Where lookups get ratings from: "http", "redis" or "file". See make_provider().
+        self.set_cvar_once("qlx_balance_provider", "http")
+        self.set_cvar_once("qlx_balance_providerhost", "www.qlranks.com")
+        self.set_cvar_once("qlx_balance_providerpath", "/api.aspx?nick={}")
+        self.set_cvar_once("qlx_balance_providerfile", "")
+        # Rate players from the results of games played here, and also of each round.
+        self.set_cvar_once("qlx_balance_localrating", "0")
+        self.set_cvar_once("qlx_balance_localratingrounds", "0")
         
         
         
-        self.suggested_pair = None
-        self.suggested_agree = [False, False]
+        self.trace = Tracer()
+        self.latency = LatencyStats()
+        # Keys: steam_id - Items: time.monotonic() of the connect still waiting for a rating
+        self.connect_times = {}
+        # Keys: steam_id - Items: [time.monotonic() of when we started waiting for their name,
+        #                        set of gametypes to resolve once it's there]
+        self.name_waits = {}
+
+        # (red players, blue players) that are suggested to switch teams.
+        self.suggested_switch = None
+        # One flag for each player in the suggested switch, reds first.
+        self.suggested_agree = []
+        # Next best switches after suggested_switch, offered if one of its players declines.
+        self.suggested_alternatives = []
+        # Steam IDs of the players who declined a switch this game, who aren't asked again.
+        self.declined = set()
         
         self.rlock = RLock()
         
-        # Keys: DataGrabber().uid - Items: (DataGrabber(), nick_list, caller)
+        # Smaller than a full server and ratings get evicted while the teams are worked out.
+        cache_size = max(self.get_cvar("qlx_balance_cachesize", int), self.get_cvar("sv_maxclients", int) or 64)
+        cache_ttl = self.get_cvar("qlx_balance_cachettl", int)
+        # Keys: DataGrabber().uid - Items: (DataGrabber(), player_list, gametype)
+        # Never evicted: an entry lives until its DataGrabber hands back, and there are at
+        # most LOOKUP_QUEUE_SIZE + LOOKUP_WORKERS of those since the pool turns away the rest.
         self.lookups = {}
-        # Rating Info in Memory key: steam_id items - (gametype, rating)
-        self.rating = {}
-        # Keys: nick - Items (steam_id, status, lookup-id, (gametype, rating))
-        self.lookup_nicks = {}
-        
-        # All Players on Server Ready to receive Tells
-        teams = self.teams()
-        self.loaded_players = teams["red"] + teams["blue"] + teams["free"] + teams["spectator"]
+        self.lookup_pool = LookupPool()
+        self.provider = self.make_provider()
+        self.circuit = CircuitBreaker()
+        # (steam_id, gametype) given the default rating because QLRanks was unreachable,
+        # and whether degraded_tick is scheduled to look them up again.
+        self.degraded = set()
+        self.degraded_armed = False
+        # All writes to the database go through here, and so should reads of keys we write.
+        self.writes = WriteBehind(self.db)
+        # Rating Info in Memory, see RatingTable. Connected players are never evicted.
+        self.rating = RatingTable(cache_size, cache_ttl, lambda steam_id: steam_id in self.roster)
+        # Keys: (steam_id, gametype) - Items: list of RatingWaiter() waiting for that rating
+        self.rating_waiters = {}
+        # Keys: (steam_id, gametype) - Items: time.monotonic() of when fetching it started
+        self.inflight = {}
+        # Keys: steam_id - Items: Player, connected players waiting for the next batched fetch
+        self.connect_buffer = {}
+        # Keys: gametype - Items: {steam_id: Player}, players whose name came in, waiting
+        # to be resolved together like connect_buffer
+        self.woken_buffer = {}
+        # Running rating sums of red and blue for the current gametype, see TeamRatings.
+        self.team_ratings = None
+        # Suggestions and balance plans worked out for the roster in plans_key, see plan().
+        # Keys: kind - Items: result
+        self.plans = {}
+        self.plans_key = None
+        # Keys: RosterSnapshot being searched - Items: list of (channel, callback, attempt)
+        # waiting for that search, so a roster is only searched once at a time.
+        self.searches = {}
+        # Whether !migrateratings is running, and whether it has ever finished.
+        self.migrating = False
+        self.profiles_migrated = _profiles_migrated_key in self.db
+        # Keys: nick - Items: NickLookup
+        self.lookup_nicks = LRUCache(cache_size, cache_ttl)
+        
+        # Who's on the server, see Roster. Built when needed, at most once a frame.
+        self._roster = None
+        # Steam IDs of all Players on Server Ready to receive Tells
+        self.loaded_players = set(self.roster.by_steam_id)
         # We flag players who ought to be kickbanned, but since we delay it, we keep
         # a list of players who are flagged and prevent them from starting votes or joining.
         self.ban_flagged = []
+        # Deadlines of the pending tells and kicks of players not meeting the rating
+        # requirements, keyed by steam_id, with one shared tick for all of them.
+        self.requirements = TimerWheel()
+        self.requirements_armed = False
+        # Keys: steam_id - Items: "spec" or "kick", the tell waiting for them to load
+        self.pending_tells = {}
 
         # A datetime.datetime instance of the point in time of the last round countdown.
         self.countdown = None
         
         self.vote = ""
 
+        # Warm up the rating cache for whoever is already on the server, so that the
+        # first !teams or !balance after a (re)load doesn't wait on the database.
+        if self.game and self.loaded_players:
+            self.preload_ratings(list(self.loaded_players), self.game.type_short)
+
     def handle_vote_called(self, caller, vote, args):
-        self.info("handle_vote_called")
+        self.trace("hooks", TRACE_DEBUG, "handle_vote_called")
         if self.is_flagged(caller):
             return minqlx.RET_STOP_ALL
         self.vote = vote
         if vote == "shuffle":
             auto_reject = self.get_cvar("qlx_balance_vetounevenshuffle", bool)
             if auto_reject:
-                teams = self.teams()
+                teams = self.roster.teams()
                 if len(teams["red"] + teams["blue"]) % 2 == 1:
                     self.msg("^7Only call shuffle votes when the total number of players is an even number.")
                     return minqlx.RET_STOP_ALL
 
     @minqlx.delay(5)
     def handle_vote_ended(self, passed):
-        self.info("handle_vote_ended")
+        self.trace("hooks", TRACE_DEBUG, "handle_vote_ended")
         vote = self.vote
         if passed == True and vote == "shuffle":
             auto = self.get_cvar("qlx_balance_autobalance", bool)
-            self.console(auto);
             if not auto:
                 return
             else:
-                teams = self.teams()
+                teams = self.roster.teams()
                 total = len(teams["red"]) + len(teams["blue"])
                 if total % 2 == 0:
                     self.average_balance(minqlx.CHAT_CHANNEL, self.game.type_short)
@@ -131,7 +312,12 @@ class balance(minqlx.Plugin):
                     self.msg("^7I can't balance when the total number of players is not an even number.")
 
     def handle_team_switch(self, player, old_team, new_team):
-        self.info("handle_team_switch, old:{} - new:{}".format(old_team, new_team))
+        self.trace("hooks", TRACE_DEBUG, "handle_team_switch, old:{} - new:{}", old_team, new_team)
+        if self._roster is not None:
+            self._roster.add(player, new_team)
+        if self.team_ratings:
+            self.team_ratings.add(player.steam_id, new_team, self.get_rating(player.steam_id, self.team_ratings.gametype))
+        self.forget_plans()
         if new_team != "spectator":
             if self.is_flagged(player):
                 player.tell("You don't meet the rating Requirement to join.")
@@ -142,61 +328,142 @@ class balance(minqlx.Plugin):
                 return self.check_rating_requirements(player, gametype, new_team, old_team)
         
     def handle_player_connect(self, player):
-        self.info("handle_player_connect")
+        self.trace("hooks", TRACE_DEBUG, "handle_player_connect")
+        self._roster = None
         gametype = self.game.type_short
         if not self.has_rating(player.steam_id, gametype):
-            self.fetch_rating([player], gametype, (self.check_rating_requirements, (player, gametype)))
+            self.connect_times[player.steam_id] = time.monotonic()
+            # Players tend to connect in bursts after a map change, so collect them
+            # for a moment and look them all up with a single request.
+            self.wait_for_rating(player.steam_id, gametype, (self.check_rating_requirements, (player, gametype)))
+            if not self.connect_buffer:
+                self.flush_connect_buffer(gametype)
+            self.connect_buffer[player.steam_id] = player
         else:
             self.check_rating_requirements(player, gametype)
+
+    @minqlx.delay(CONNECT_COALESCE_WINDOW)
+    def flush_connect_buffer(self, gametype):
+        self.trace("rating", TRACE_DEBUG, "flush_connect_buffer")
+        players = list(self.connect_buffer.values())
+        self.connect_buffer = {}
+        now = time.monotonic()
+        for player in players:
+            if player.steam_id in self.connect_times:
+                self.latency.record("coalesce", now - self.connect_times[player.steam_id])
+        if players:
+            self.fetch_rating(players, gametype, None)
             
+    @property
+    def roster(self):
+        """The players on the server, indexed. Only for use on the game thread."""
+        if self._roster is None:
+            self._roster = Roster(self.teams())
+            self.expire_roster()
+        return self._roster
+
+    @minqlx.next_frame
+    def expire_roster(self):
+        self._roster = None
+
     def handle_player_disconnect(self, player, reason):
-        if player.steam_id in self.loaded_players:
-            self.loaded_players.remove(player)
+        self.connect_buffer.pop(player.steam_id, None)
+        for players in self.woken_buffer.values():
+            players.pop(player.steam_id, None)
+        self.connect_times.pop(player.steam_id, None)
+        self.name_waits.pop(player.steam_id, None)
+        self.forget_rating_waits(player.steam_id)
+        self.forget_plans()
+        self.requirements.cancel(player.steam_id)
+        self.pending_tells.pop(player.steam_id, None)
+        if self.team_ratings:
+            self.team_ratings.remove(player.steam_id)
+        self.loaded_players.discard(player.steam_id)
+        self.roster.remove(player.steam_id)
 
     @minqlx.delay(1)
     def handle_player_loaded(self, player):
-        self.info("handle_player_loaded")
+        self.trace("hooks", TRACE_DEBUG, "handle_player_loaded")
         gametype = self.game.type_short
         player.tell("This Server is ELO Managed.")
-        self.loaded_players.append(player.steam_id)
+        self.loaded_players.add(player.steam_id)
+        self.wake_for_name(player)
+        if player.steam_id in self.pending_tells:
+            self.deliver_tell(player, self.pending_tells.pop(player.steam_id))
         if not self.is_flagged(player):
             if player.clean_name in self.lookup_nicks:
-                if self.lookup_nicks[player.clean_name][1] == "failed":
+                if self.lookup_nicks[player.clean_name].status == "failed":
                     player.tell("^7Type '^6!iam ^2<Your-old-Quakelive-Nick>^7' to get a Rating.")
 
+    def handle_userinfo(self, player, changed):
+        if "name" in changed and player.steam_id in self.name_waits:
+            self.userinfo_applied(player.steam_id)
+
+    @minqlx.next_frame
+    def userinfo_applied(self, steam_id):
+        # The hook runs before the new userinfo is set, so look again a frame later.
+        player = self.roster.player(steam_id)
+        if player:
+            self.wake_for_name(player)
+
     def handle_round_countdown(self, round):
-        self.info("handle_round_countdown")
-        if self.suggested_agree[0] and self.suggested_agree[1]:
+        self.trace("hooks", TRACE_DEBUG, "handle_round_countdown")
+        if self.suggested_switch and all(self.suggested_agree):
             self.execute_suggestion()
         
         self.countdown = datetime.datetime.now()
 
-    def handle_game_end(self, game, score="", winner=""):
-        self.info("handle_game_end")
+    def handle_game_end(self, data):
+        self.trace("hooks", TRACE_DEBUG, "handle_game_end")
         # Clear suggestion when the game ends to avoid weird behavior if a pending switch
         # is present and the players decide to do a rematch without doing !teams in-between.
-        self.suggested_pair = None
-        self.suggested_agree = [False, False]
-        
-        
-       
+        self.suggested_switch = None
+        self.suggested_agree = []
+        self.suggested_alternatives = []
+        self.declined = set()
+
+        if self.get_cvar("qlx_balance_localrating", bool) and not data.get("ABORTED"):
+            try:
+                red, blue = int(data["TSCORE0"]), int(data["TSCORE1"])
+            except (KeyError, TypeError, ValueError):
+                return
+            score = 1.0 if red > blue else 0.0 if red < blue else 0.5
+            self.rate_result(self.game.type_short, score, 1, True)
+
+    def handle_round_end(self, data):
+        if not (self.get_cvar("qlx_balance_localrating", bool) and self.get_cvar("qlx_balance_localratingrounds", bool)):
+            return
+        score = {"RED": 1.0, "BLUE": 0.0, "DRAW": 0.5}.get(data.get("TEAM_WON"))
+        if score is not None:
+            self.rate_result(self.game.type_short, score, ELO_ROUND_WEIGHT, False)
+
+    def handle_unload(self, plugin):
+        if plugin == self.__class__.__name__:
+            self.lookup_pool.stop()
+            self.writes.stop()
 
     def cmd_ratinginfo(self, player, msg, channel):
-        self.info("cmd_ratinginfo")
+        self.trace("commands", TRACE_DEBUG, "cmd_ratinginfo")
         gametype = self.game.type_short
-        rating_key = _rating_gametype_key.format(player.steam_id, self.game.type_short)
-        if rating_key in self.db:
-            channel.reply("Your rating for {} in db: {}.".format(gametype, self.db[rating_key]))
-        quakelive_key = _quakelive_key.format(player.steam_id)
-        if quakelive_key in self.db:
-            channel.reply("Your qlranks-nick in db: {}.".format(self.db[quakelive_key]))
+        profile = self.read_profiles([player.steam_id])[player.steam_id]
+        rating = profile.get(gametype)
+        if rating is not None:
+            channel.reply("Your rating for {} in db: {}.".format(gametype, rating))
+        nick = profile.get("nick")
+        if nick is not None:
+            channel.reply("Your qlranks-nick in db: {}.".format(nick))
         if self.has_rating(player.steam_id, self.game.type_short):
             channel.reply("Your rating for {} in memory: {}.".format(gametype, self.get_rating(player.steam_id, gametype)))
         if player.clean_name in self.lookup_nicks:
-            channel.reply("Your lookup to qlranks for '{}' is {}.".format(player.clean_name, self.lookup_nicks[player.clean_name][1]))
+            channel.reply("Your lookup to qlranks for '{}' is {}.".format(player.clean_name, self.lookup_nicks[player.clean_name].status))
+        channel.reply("Rating cache: {}.".format(self.rating.stats()))
+        channel.reply("Nick cache: {}.".format(self.lookup_nicks.stats()))
+        channel.reply("Lookups running: {}/{}.".format(len(self.lookups), LOOKUP_QUEUE_SIZE + LOOKUP_WORKERS))
+        channel.reply("Rating provider: {}.".format(self.provider.name))
+        channel.reply("QLRanks circuit: {}.".format(self.circuit.stats()))
     
     def cmd_allelo(self, player, msg, channel):
-        teams = self.teams()
+        teams = self.roster.teams()
         gametype = self.game.type_short
         
         players = teams["red"] + teams["blue"] + teams["spectator"]
@@ -221,29 +488,27 @@ class balance(minqlx.Plugin):
         return
 
     def cmd_setnick(self, player, msg, channel):
-        self.info("cmd_setnick")
+        self.trace("commands", TRACE_DEBUG, "cmd_setnick")
         if len(msg) < 2:
             return minqlx.RET_USAGE
         nick = msg[1]
         self.testnick(player, nick)
 
     def cmd_getnick(self, player, msg, channel):
-        self.info("cmd_getnick")
+        self.trace("commands", TRACE_DEBUG, "cmd_getnick")
         ret, theplayer = self.check_input(msg, player)
         if ret:
             return ret
-        qlranks_key = _quakelive_key.format(theplayer.steam_id)
-        nick = self.db[qlranks_key]
+        nick = self.read_profiles([theplayer.steam_id])[theplayer.steam_id].get("nick")
         channel.reply("{}'s quakelive-Nick is set to ^2{}^7.".format(theplayer.name, nick))
 
     def cmd_setnickfor(self, player, msg, channel):
-        self.info("cmd_setnickfor")
+        self.trace("commands", TRACE_DEBUG, "cmd_setnickfor")
         ret, theplayer = self.check_input(msg, player, 3, 2)
         if ret:
             return ret
         if len(msg) < 3:
-            qlranks_key = _quakelive_key.format(theplayer.steam_id)
-            del self.db[qlranks_key]
+            self.store_profile(theplayer.steam_id, "nick", None)
             self.remove_rating(theplayer.steam_id, self.game.type_short)
             channel.reply("{}'s quakelive-Nick has been removed.".format(theplayer.name))
             return
@@ -253,27 +518,27 @@ class balance(minqlx.Plugin):
         return
         
     def cmd_getrating(self, player, msg, channel):
-        self.info("cmd_getrating")
+        self.trace("commands", TRACE_DEBUG, "cmd_getrating")
         ret, theplayer = self.check_input(msg, player)
         if ret:
             return ret
         self.report_rating([theplayer], channel)
     
     def cmd_remrating(self, player, msg, channel):
-        self.info("cmd_remrating")
+        self.trace("commands", TRACE_DEBUG, "cmd_remrating")
         ret, theplayer = self.check_input(msg, player)
         if ret:
             return ret
-        rating_key = _rating_gametype_key.format(theplayer.steam_id, self.game.type_short)
-        if not self.db[rating_key] and not self.has_rating(theplayer.steam_id, self.game.type_short):
+        stored = self.read_profiles([theplayer.steam_id])[theplayer.steam_id].get(self.game.type_short)
+        if not stored and not self.has_rating(theplayer.steam_id, self.game.type_short):
             channel.reply("{}'s has no rating in {} yet.".format(theplayer.name, self.game.type))
         else:
-            del self.db[rating_key]
+            self.store_profile(theplayer.steam_id, self.game.type_short, None)
             self.remove_rating(theplayer.steam_id, self.game.type_short)
             channel.reply("{}'s {} rating is removed.".format(theplayer.name, self.game.type))
         
     def cmd_set_rating(self, player, msg, channel):
-        self.info("cmd_set_rating")
+        self.trace("commands", TRACE_DEBUG, "cmd_set_rating")
         ret, theplayer = self.check_input(msg, player, 3, 3)
         if ret:
             return ret
@@ -281,15 +546,14 @@ class balance(minqlx.Plugin):
             i = int(msg[len(msg)-1])
         except ValueError:
             return minqlx.RET_USAGE
-        rating_key = _rating_gametype_key.format(theplayer.steam_id, self.game.type_short)
-        self.db[rating_key] = i
+        self.store_profile(theplayer.steam_id, self.game.type_short, i)
         self.remove_rating(theplayer.steam_id, self.game.type_short)
         channel.reply("{}'s {} rating is set to ^6{}^7.".format(player.name, self.game.type, i))
      
     def cmd_teams(self, player, msg, channel):
         """Displays the average ratings of each team, the difference between those values,
         as well as a switch suggestion that the bot determined would improve balance."""
-        teams = self.teams()
+        teams = self.roster.teams()
         diff = len(teams["red"]) - len(teams["blue"])
         if not diff:
             self.teams_info(channel, self.game.type_short)
@@ -299,7 +563,7 @@ class balance(minqlx.Plugin):
     def cmd_balance(self, player, msg, channel):
         """Makes the bot switch players around in an attempt to create balanced teams based
         on ratings."""
-        teams = self.teams()
+        teams = self.roster.teams()
         total = len(teams["red"]) + len(teams["blue"])
         if total % 2 == 0:
             self.average_balance(channel, self.game.type_short)
@@ -308,18 +572,17 @@ class balance(minqlx.Plugin):
 
     def cmd_do(self, player, msg, channel):
         """Forces a suggested switch to be done."""
-        if self.suggested_pair:
+        if self.suggested_switch:
             self.execute_suggestion()
 
     def cmd_agree(self, player, msg, channel):
         """After the bot suggests a switch, players in question can use this to agree to the switch."""
-        if self.suggested_pair and not (self.suggested_agree[0] and self.suggested_agree[1]):
-            if self.suggested_pair[0] == player:
-                self.suggested_agree[0] = True
-            elif self.suggested_pair[1] == player:
-                self.suggested_agree[1] = True
+        if self.suggested_switch and not all(self.suggested_agree):
+            players = self.suggested_switch[0] + self.suggested_switch[1]
+            if player in players:
+                self.suggested_agree[players.index(player)] = True
 
-            if self.suggested_agree[0] and self.suggested_agree[1]:
+            if all(self.suggested_agree):
                 # If the game's in progress and we're not in the round_countdown time window, wait for next round.
                 if self.game.state == "in_progress" and self.countdown:
                     td = datetime.datetime.now() - self.countdown
@@ -330,34 +593,119 @@ class balance(minqlx.Plugin):
                 # Otherwise, switch right away.
                 self.execute_suggestion()   
 
+    def cmd_decline(self, player, msg, channel):
+        """Lets a player in the suggested switch turn it down, moving on to the next best
+        one without them. They aren't suggested to switch again this game."""
+        if not self.suggested_switch or player not in self.suggested_switch[0] + self.suggested_switch[1]:
+            return
+
+        self.declined.add(player.steam_id)
+        self.suggested_alternatives = [a for a in self.suggested_alternatives if not self.involves_declined(a[0])]
+        while self.suggested_alternatives:
+            switch, improvement = self.suggested_alternatives.pop(0)
+            # Skip alternatives that went stale since they were computed.
+            if all(p.team == "red" for p in switch[0]) and all(p.team == "blue" for p in switch[1]):
+                self.set_suggestion(switch)
+                self.msg("^7{} declined. SUGGESTION: switch {}. Type !a to agree."
+                    .format(player.clean_name, self.describe_switch(switch)))
+                return
+
+        self.suggested_switch = None
+        self.suggested_agree = []
+        self.msg("^7{} declined. There are no other switches to suggest.".format(player.clean_name))
+
     def has_rating(self, steam_id, gametype):
-        self.info("has_rating")
-        if steam_id in self.rating:
-            if gametype in self.rating[steam_id]:
-                return True
-        return False
+        return self.rating.has(steam_id, gametype)
         
     def set_rating(self, steam_id, gametype, rating):
-        self.info("set_rating")
-        if not steam_id in self.rating:
-            self.rating[steam_id] = {}
-        self.rating[steam_id][gametype] = int(rating)
+        self.trace("rating", TRACE_DEBUG, "set_rating {} {} {}", steam_id, gametype, rating)
+        self.rating.set(steam_id, gametype, int(rating))
+        if self.team_ratings and self.team_ratings.gametype == gametype:
+            self.team_ratings.update(steam_id, int(rating))
+        self.forget_plans()
+        self.rating_arrived(steam_id, gametype)
+
+    def wait_for_rating(self, steam_id, gametype, callback):
+        """Runs callback once the rating of steam_id for gametype has been set."""
+        self.wait_for_ratings([steam_id], gametype, callback)
+
+    def wait_for_ratings(self, steam_ids, gametype, callback):
+        """Runs callback once the ratings of all steam_ids for gametype have been set.
+        The same callback already waiting for the same ratings isn't added twice."""
+        keys = {(steam_id, gametype) for steam_id in steam_ids}
+        for waiter in self.rating_waiters.get(next(iter(keys)), ()):
+            if waiter.callback == callback and waiter.pending == keys:
+                return
+        waiter = RatingWaiter(keys, callback)
+        for key in keys:
+            self.rating_waiters.setdefault(key, []).append(waiter)
+
+    def rating_arrived(self, steam_id, gametype):
+        key = (steam_id, gametype)
+        if steam_id in self.connect_times:
+            self.latency.record("connect_to_rating", time.monotonic() - self.connect_times.pop(steam_id))
+        self.inflight.pop(key, None)
+        for waiter in self.rating_waiters.pop(key, ()):
+            waiter.pending.discard(key)
+            if not waiter.pending:
+                waiter.callback[0](*waiter.callback[1])
+
+    def forget_rating_waits(self, steam_id):
+        """Stops waiting on the ratings of a player that left. Callbacks that were
+        only waiting on others are run once those are in."""
+        for gametype in ELO_GAMETYPES:
+            key = (steam_id, gametype)
+            self.inflight.pop(key, None)
+            for waiter in self.rating_waiters.pop(key, ()):
+                waiter.pending.discard(key)
+                if not waiter.pending and len(waiter.keys) > 1:
+                    waiter.callback[0](*waiter.callback[1])
         
     def get_rating(self, steam_id, gametype):
-        self.info("get_rating")
-        if steam_id in self.rating:
-            if gametype in self.rating[steam_id]:
-                return self.rating[steam_id][gametype]
-        return self.get_cvar("qlx_balance_defaultrating")
+        rating = self.rating.get(steam_id, gametype)
+        if rating is not None:
+            return rating
+        return self.get_cvar("qlx_balance_defaultrating", int)
         
     def remove_rating(self, steam_id, gametype):
-        self.info("remove_rating")
-        if steam_id in self.rating:
-            if gametype in self.rating[steam_id]:
-                del self.rating[steam_id][gametype]
+        if self.rating.remove(steam_id, gametype):
+            if self.team_ratings and self.team_ratings.gametype == gametype:
+                self.team_ratings.update(steam_id, self.get_rating(steam_id, gametype))
+            self.forget_plans()
         
+    def rate_result(self, gametype, score, weight, count_game):
+        """Updates the ratings of everyone on red and blue from a result, score being
+        1 for a red win, 0 for a blue win and 0.5 for a draw, and queues the writes.
+        Players without a real rating, either not known yet or given the default while
+        QLRanks was unreachable, still count towards their team's strength but keep
+        their rating, so that a placeholder never gets stored as theirs."""
+        if gametype not in LOCAL_RATING_GAMETYPES:
+            return
+        teams = self.roster.teams()
+        steam_ids = [p.steam_id for p in teams["red"] + teams["blue"]]
+        reds = len(teams["red"])
+        if not reds or reds == len(steam_ids):
+            return
+        games = array("l", (int(g or 0) for g in self.writes.mget([_games_key.format(sid, gametype) for sid in steam_ids])))
+        ratings = array("d", (self.get_rating(sid, gametype) for sid in steam_ids))
+        unrated = {sid for sid in steam_ids
+                   if not self.has_rating(sid, gametype) or (sid, gametype) in self.degraded}
+        k = array("d", (weight * (ELO_PROVISIONAL_K if g < ELO_PROVISIONAL_GAMES else ELO_K) for g in games))
+        new_ratings = elo_update(ratings, k, reds, score)
+        if self.trace.enabled("rating", TRACE_INFO):
+            self.trace("rating", TRACE_INFO, "local ratings for {} after {}: {}", gametype, score,
+                       {sid: (int(ratings[i]), round(new_ratings[i])) for i, sid in enumerate(steam_ids)})
+        for i, steam_id in enumerate(steam_ids):
+            if steam_id in unrated:
+                continue
+            rating = round(new_ratings[i])
+            self.set_rating(steam_id, gametype, rating)
+            self.store_profile(steam_id, gametype, rating)
+            if count_game:
+                self.writes.set(_games_key.format(steam_id, gametype), games[i] + 1)
+
     def report_rating(self, player_list, channel):
-        self.info("report_rating")
+        self.trace("rating", TRACE_DEBUG, "report_rating")
         pending_players = []
         for player in player_list:
             if not self.has_rating(player.steam_id, self.game.type_short):
@@ -371,7 +719,6 @@ class balance(minqlx.Plugin):
         self.fetch_rating(player_list, self.game.type_short, (self.report_rating, (player_list, channel)))
         
     def fix_old_nick(self, name):
-        self.info("fix_old_nick")
         #select the largest part when nick with spaces
         tmpname = ''.join(i for i in name if ord(i)<128)
         tmpname = tmpname.replace(".","")
@@ -384,20 +731,36 @@ class balance(minqlx.Plugin):
             newname = tmpname
         return newname
             
-    def fetch_rating(self, player_list, gametype, callback, retry = 0, old_nick = ""):
-        self.info("fetch_rating")
-        
-        if retry: # in Retry, at least one name in list was not yet set, reget all players
-            tmp = []
-            for player in player_list:
-                newplayer = player
-                if not player.clean_name:
-                    try:
-                        newplayer = self.player(player.steam_id)
-                    except:
-                        newplayer = player
-                tmp.append(newplayer)
-            player_list = tmp
+    def fetch_rating(self, player_list, gametype, callback, old_nick = ""):
+        """Gets the ratings of player_list for gametype and runs callback once all of
+        them are in. Ratings that are already being fetched aren't fetched again,
+        the callback just waits for them as well."""
+        self.trace("rating", TRACE_DEBUG, "fetch_rating")
+        missing = [p for p in player_list if not self.has_rating(p.steam_id, gametype)]
+        if not missing:
+            if callback:
+                callback[0](*callback[1])
+            return
+
+        if callback:
+            self.wait_for_ratings([p.steam_id for p in missing], gametype, callback)
+
+        # An old nick means the player told us who they are, so that always gets looked up.
+        now = time.monotonic()
+        to_fetch = []
+        for player in missing:
+            key = (player.steam_id, gametype)
+            if old_nick or key not in self.inflight or now - self.inflight[key] > LOOKUP_TTL:
+                self.inflight[key] = now
+                to_fetch.append(player)
+        if to_fetch:
+            self.resolve_ratings(to_fetch, gametype, old_nick)
+
+    def resolve_ratings(self, player_list, gametype, old_nick = ""):
+        """Sets the ratings of player_list from the database, the QLRanks lookups or
+        the default rating. Players that need a lookup get their rating later, as do
+        players whose name isn't there yet (see wait_for_name)."""
+        self.trace("rating", TRACE_DEBUG, "resolve_ratings")
         
         def get_players_without_rating(self, player_list):
             players_without_rating = []
@@ -408,15 +771,14 @@ class balance(minqlx.Plugin):
 
         players_without_rating = get_players_without_rating(self, player_list)
         # Check DB
+        stored = self.read_ratings_and_nicks([p.steam_id for p in players_without_rating], gametype)
         for player in players_without_rating:
-            rating_key = _rating_gametype_key.format(player.steam_id, gametype)
-            rating = self.db[rating_key]
+            rating = stored[player.steam_id][0]
             if rating:
                 self.set_rating(player.steam_id, gametype, rating)
                 
         players_without_rating = get_players_without_rating(self, player_list)
         # Check External Sources
-        wait_for_name = False
         if players_without_rating:
             handled_players = []
             qlranks_names = {}
@@ -424,29 +786,26 @@ class balance(minqlx.Plugin):
                 if old_nick:
                     qlranks_name = old_nick
                 else:
-                    qlranks_key = _quakelive_key.format(player.steam_id)
-                    qlranks_name = self.db[qlranks_key]
+                    qlranks_name = stored[player.steam_id][1]
                 if not qlranks_name:
                     cleanname = player.clean_name
                     if cleanname:
                         qlranks_name = cleanname
-                    else: # clean_name not set yet, wait for a bit
-                        if retry < 20:
-                            wait_for_name = True
-                            handled_players.append(player)
-                        else: # no clean_name after 20 seconds, set default rating
-                            self.set_rating(player.steam_id, gametype, self.get_cvar("qlx_balance_defaultrating"))
+                    else: # clean_name not set yet, park the player until it is
+                        self.wait_for_name(player, gametype)
+                        handled_players.append(player)
+                        continue
                 if qlranks_name:
                     qlranks_name = self.fix_old_nick(qlranks_name)
                 if qlranks_name and qlranks_name in self.lookup_nicks: # is in lookup or lookup finished
-                    if self.lookup_nicks[qlranks_name][0] != player.steam_id: # trying to look up nick for another steam_id, warning using default
+                    if self.lookup_nicks[qlranks_name].steam_id != player.steam_id: # trying to look up nick for another steam_id, warning using default
                         self.msg("^2{}^7 already in use. Setting '^2{}^7' to the default Rating of ^6{}^7.".format(qlranks_name, player.clean_name, self.get_cvar("qlx_balance_defaultrating")))
                         self.set_rating(player.steam_id, gametype, self.get_cvar("qlx_balance_defaultrating"))
-                    elif self.lookup_nicks[qlranks_name][1] == "failed": # lookup already failed, so set default rating
+                    elif self.lookup_nicks[qlranks_name].status == "failed": # lookup already failed, so set default rating
                         self.set_rating(player.steam_id, gametype, self.get_cvar("qlx_balance_defaultrating"))
-                    elif self.lookup_nicks[qlranks_name][1] == "found": # lookup already found rating, set it
-                        if gametype in self.lookup_nicks[qlranks_name][3]:
-                            rank_rating = self.lookup_nicks[qlranks_name][3][gametype]
+                    elif self.lookup_nicks[qlranks_name].status == "found": # lookup already found rating, set it
+                        if gametype in self.lookup_nicks[qlranks_name].ratings:
+                            rank_rating = self.lookup_nicks[qlranks_name].ratings[gametype]
                         else:
                             rank_rating = self.get_cvar("qlx_balance_defaultrating")
                         self.set_rating(player.steam_id, gametype, rank_rating)
@@ -456,20 +815,35 @@ class balance(minqlx.Plugin):
                     qlranks_names[player.steam_id] = qlranks_name
                     handled_players.append(player)
                 else:
-                    if not wait_for_name:
-                        self.set_rating(player.steam_id, gametype, self.get_cvar("qlx_balance_defaultrating"))
-                    
-            if wait_for_name:
-                self.fetch_rating_delayed(player_list, gametype, callback, retry)
+                    self.set_rating(player.steam_id, gametype, self.get_cvar("qlx_balance_defaultrating"))
             
+            # Don't bother QLRanks again about nicks it recently had nothing on,
+            # unless it's a player telling us their nick.
+            if qlranks_names and not old_nick:
+                failed = self.writes.mget([_qlranks_failed_key.format(name) for name in qlranks_names.values()])
+                for (steam_id, name), is_failed in list(zip(qlranks_names.items(), failed)):
+                    if is_failed:
+                        del qlranks_names[steam_id]
+                        self.lookup_nicks[name] = NickLookup(steam_id, "failed")
+                        self.set_rating(steam_id, gametype, self.get_cvar("qlx_balance_defaultrating"))
+
+            # With QLRanks down there's no point in waiting for it, so fall back to the
+            # default rating now and look these players up again once it's back.
+            if qlranks_names and not self.circuit.available():
+                if self.trace.enabled("lookup", TRACE_INFO):
+                    self.trace("lookup", TRACE_INFO, "circuit open, not searching {}", ",".join(qlranks_names.values()))
+                for steam_id in qlranks_names:
+                    self.degrade(steam_id, gametype)
+                qlranks_names = {}
+
             if len(qlranks_names):
-                lookup = DataGrabber(self, qlranks_names)
+                lookup = DataGrabber(self, qlranks_names, self.provider)
                 all_names = ""
                 for steam_id, name in qlranks_names.items():
-                    self.lookup_nicks[name] = [steam_id, "pending", lookup.uid, {}]
+                    self.lookup_nicks[name] = NickLookup(steam_id, "pending", lookup.uid)
                     all_names += name + ","
-                self.console("searching "+all_names)
-                self.lookups[lookup.uid] = (lookup, player_list, gametype, callback)
+                self.trace("lookup", TRACE_INFO, "searching {}", all_names)
+                self.lookups[lookup.uid] = (lookup, player_list, gametype)
                 lookup.start()
         
         players_without_rating = get_players_without_rating(self, player_list)
@@ -479,67 +853,257 @@ class balance(minqlx.Plugin):
                 if test not in handled_players:
                     self.msg("^2{}^7 fell through all Nets.".format(test.clean_name))
                     return
-            # all players without rating will be handled and fetch_rating will be recalled
-        else: #no unhandled players left, call callback and be done
-            if callback:
-                callback[0](*callback[1])
+            # all players without rating will be handled and resolve_ratings will be recalled
             
-    @minqlx.delay(1)
-    def fetch_rating_delayed(self, player_list, gametype, callback, retry):
-        self.info("fetch_rating_delayed")
-        return self.fetch_rating(player_list, gametype, callback, retry+1)
+    @minqlx.thread
+    def preload_ratings(self, steam_ids, gametype):
+        """Reads the stored ratings of steam_ids for every gametype at once."""
+        try:
+            profiles = self.read_profiles(steam_ids)
+        except Exception:
+            minqlx.log_exception(self)
+            return
+        stored = {}
+        for steam_id, profile in profiles.items():
+            for gt in ELO_GAMETYPES:
+                if profile.get(gt):
+                    stored[(steam_id, gt)] = profile[gt]
+        self.preload_ratings_done(stored, steam_ids, gametype)
+
+    @minqlx.next_frame
+    def preload_ratings_done(self, stored, steam_ids, gametype):
+        self.trace("rating", TRACE_DEBUG, "preload_ratings_done")
+        for (steam_id, gt), rating in stored.items():
+            if not self.has_rating(steam_id, gt):
+                self.set_rating(steam_id, gt, rating)
+
+        # Whoever isn't in the database yet is looked up right away as well.
+        players = []
+        for steam_id in steam_ids:
+            if not self.has_rating(steam_id, gametype):
+                player = self.roster.player(steam_id)
+                if player:
+                    players.append(player)
+        if players:
+            self.fetch_rating(players, gametype, None)
+
+    def read_ratings_and_nicks(self, steam_ids, gametype):
+        """Reads the stored rating for gametype and the old quakelive nick of every
+        steam_id. Returns {steam_id: (rating, nick)}."""
+        if not steam_ids:
+            return {}
+        start = time.monotonic()
+        profiles = self.read_profiles(steam_ids)
+        self.latency.record("db", time.monotonic() - start)
+        return {steam_id: (profile.get(gametype), profile.get("nick")) for steam_id, profile in profiles.items()}
+
+    def read_profiles(self, steam_ids):
+        """The stored ratings and old quakelive nick of each of steam_ids, as
+        {steam_id: {gametype or "nick": value}}. All profile hashes are read in one
+        round trip. Players who haven't been migrated yet take a second one, for an
+        MGET of their old keys, with the hash winning where both have a value. Those
+        without any old keys are marked migrated, so they only take it once, and
+        nobody does after a complete !migrateratings."""
+        profiles = dict(zip(steam_ids, self.writes.hgetall([_profile_key.format(sid) for sid in steam_ids])))
+        if self.profiles_migrated:
+            return profiles
+        unmigrated = [sid for sid, profile in profiles.items() if "migrated" not in profile]
+        if unmigrated:
+            fields = ELO_GAMETYPES + ("nick",)
+            values = self.writes.mget([old_profile_key(sid, field) for sid in unmigrated for field in fields])
+            for i, steam_id in enumerate(unmigrated):
+                found = False
+                for j, field in enumerate(fields):
+                    value = values[i * len(fields) + j]
+                    if value is not None:
+                        profiles[steam_id].setdefault(field, value)
+                        found = True
+                if not found:
+                    self.writes.hset(_profile_key.format(steam_id), "migrated", 1)
+        return profiles
+
+    def store_profile(self, steam_id, field, value):
+        """Queues a write of a field of the profile of steam_id, a value of None
+        deleting it. A deletion also goes to the old key, which would otherwise
+        still be read for players that haven't been migrated."""
+        if value is None:
+            self.writes.hdel(_profile_key.format(steam_id), field)
+            self.writes.delete(old_profile_key(steam_id, field))
+        else:
+            self.writes.hset(_profile_key.format(steam_id), field, value)
+
+    def wait_for_name(self, player, gametype):
+        """Parks player until their name is there. player_loaded or a userinfo
+        change wakes them up, and name_wait_expired gives up on them."""
+        if player.steam_id in self.name_waits:
+            self.name_waits[player.steam_id][1].add(gametype)
+            return
+        self.trace("rating", TRACE_DEBUG, "waiting for the name of {}", player.steam_id)
+        since = time.monotonic()
+        self.name_waits[player.steam_id] = [since, {gametype}]
+        self.name_wait_expired(player.steam_id, since)
+
+    def wake_for_name(self, player):
+        """Resolves the ratings player was parked for, if their name is there now. The
+        names of a burst of connecting players come in one by one, so they're collected
+        for a moment and resolved together, like in flush_connect_buffer."""
+        if player.steam_id not in self.name_waits or not player.clean_name:
+            return
+        since, gametypes = self.name_waits.pop(player.steam_id)
+        self.latency.record("name_wait", time.monotonic() - since)
+        if not self.woken_buffer:
+            self.flush_woken_buffer()
+        for gametype in gametypes:
+            self.woken_buffer.setdefault(gametype, {})[player.steam_id] = player
+
+    @minqlx.delay(CONNECT_COALESCE_WINDOW)
+    def flush_woken_buffer(self):
+        self.trace("rating", TRACE_DEBUG, "flush_woken_buffer")
+        woken = self.woken_buffer
+        self.woken_buffer = {}
+        for gametype, players in woken.items():
+            if players:
+                self.resolve_ratings(list(players.values()), gametype)
+
+    @minqlx.delay(NAME_WAIT_TIMEOUT)
+    def name_wait_expired(self, steam_id, since):
+        if steam_id not in self.name_waits or self.name_waits[steam_id][0] != since:
+            return # woken up, or disconnected and maybe back with a new wait
+        player = self.roster.player(steam_id)
+        if player and player.clean_name:
+            return self.wake_for_name(player)
+        self.trace("rating", TRACE_INFO, "no name for {} after {}s, using the default rating", steam_id, NAME_WAIT_TIMEOUT)
+        gametypes = self.name_waits.pop(steam_id)[1]
+        self.latency.record("name_wait", time.monotonic() - since)
+        for gametype in gametypes:
+            self.set_rating(steam_id, gametype, self.get_cvar("qlx_balance_defaultrating"))
         
     @minqlx.next_frame
     def fetch_rating_datagrabber(self, response, datagrabber):
-        self.info("fetch_rating_datagrabber")
-        lookup = self.lookups[datagrabber.uid]
+        self.trace("lookup", TRACE_DEBUG, "fetch_rating_datagrabber")
+        self.record_lookup_spans(datagrabber)
+        lookup = self.lookups.pop(datagrabber.uid, None)
         if not lookup:
-            self.msg("Lookup not found.")
+            # Don't leave its nicks pending until they expire: forget them so the next
+            # fetch_rating looks them up again, and give the players the fallback rating.
+            self.trace("lookup", TRACE_INFO, "lookup {} not found", datagrabber.uid)
+            for name, data in self.lookup_nicks.items():
+                if data.status == "pending" and data.uid == datagrabber.uid:
+                    del self.lookup_nicks[name]
+                    for steam_id, gametype in [key for key in self.inflight if key[0] == data.steam_id]:
+                        self.degrade(steam_id, gametype)
             return
         condensed_data = {}
         if datagrabber.status == 200 and response:
-            for qlName in response["players"]:
-                if not "nick" in qlName:
-                    continue
-                nick = qlName["nick"]
-                ratings = {}
-                for gametype in ELO_GAMETYPES:
-                    if qlName[gametype]:
-                        if qlName[gametype]["rank"]:
-                            ratings[gametype] = qlName[gametype]["elo"]
-                if ratings:
-                    condensed_data[nick] = ratings
+            condensed_data = response
         gametype_now = lookup[2]
-        #self.lookup_nicks: [steam_id:status:time:(gametype:elo)]
         for name, ratings in condensed_data.items():
             if name in self.lookup_nicks:
-                steam_id = self.lookup_nicks[name][0]
-                self.lookup_nicks[name][1] = "found"
+                steam_id = self.lookup_nicks[name].steam_id
+                self.lookup_nicks[name].status = "found"
+                self.lookup_nicks[name].ratings = ratings
                 # set the nick in database and report
                 """player = self.player(steam_id) 
                 if player:
                     self.setnick(player, name)"""
-                for gametype, rating in condensed_data[name].items():
-                    self.lookup_nicks[name][3][gametype] = rating
+                for gametype, rating in ratings.items():
                     if gametype == gametype_now:
                         self.set_rating(steam_id, gametype, rating)
 
             else:
-                self.lookup_nicks[name] = [0, "failed", datagrabber.uid, {}]
+                self.lookup_nicks[name] = NickLookup(0, "failed", datagrabber.uid)
                 self.msg("^2{}^7 has no QLRanks.com - Rating for ^6{}^7.".format(name, gametype_now))
+        failed_ttl = self.get_cvar("qlx_balance_failedlookupttl", int)
         for name, data in self.lookup_nicks.items():
-            if data[1] == "pending" and data[2] == datagrabber.uid:
-                self.lookup_nicks[name][1] = "failed"
+            if data.status == "pending" and data.uid == datagrabber.uid:
+                if datagrabber.status != 200:
+                    # A failed request says nothing about the player, so don't remember
+                    # the nick as failed and try again later.
+                    del self.lookup_nicks[name]
+                    self.degrade(data.steam_id, gametype_now)
+                    continue
+                data.status = "failed"
+                if failed_ttl > 0:
+                    self.writes.set(_qlranks_failed_key.format(name), 1, failed_ttl)
                 self.msg("^2{}^7 has no QLRanks.com - Rating for ^6{}^7.".format(name, gametype_now))
-        del self.lookups[datagrabber.uid]
+        if datagrabber.status == 200 and self.degraded:
+            self.retry_degraded()
         
-        return self.fetch_rating(lookup[1], lookup[2], lookup[3])
+        return self.resolve_ratings([p for p in lookup[1] if not self.has_rating(p.steam_id, lookup[2])], lookup[2])
+
+    def record_lookup_spans(self, datagrabber):
+        now = time.monotonic()
+        spans = {"lookup": now - datagrabber.created}
+        if datagrabber.started:
+            spans["queue"] = datagrabber.started - datagrabber.created
+        if datagrabber.started and datagrabber.fetched:
+            spans["http"] = datagrabber.fetched - datagrabber.started
+        if datagrabber.fetched:
+            spans["handback"] = now - datagrabber.fetched
+        for stage, seconds in spans.items():
+            self.latency.record(stage, seconds)
+        if self.trace.enabled("lookup", TRACE_INFO):
+            self.trace("lookup", TRACE_INFO, "lookup #{} status {}: {}", datagrabber.uid, datagrabber.status,
+                ", ".join("{} {:.1f}ms".format(stage, seconds * 1000) for stage, seconds in spans.items()))
+
+    def make_provider(self):
+        """The rating provider picked by qlx_balance_provider:
+            http  - a QLRanks style JSON API at qlx_balance_providerhost and qlx_balance_providerpath
+            redis - hashes of gametype ratings per nick in our own database
+            file  - a JSON file of nick -> {gametype: rating} at qlx_balance_providerfile
+        """
+        kind = self.get_cvar("qlx_balance_provider")
+        if kind == "redis":
+            return RedisProvider(self.db)
+        elif kind == "file":
+            return FileProvider(self.get_cvar("qlx_balance_providerfile"))
+        else:
+            return HttpJsonProvider(self.get_cvar("qlx_balance_providerhost"), self.get_cvar("qlx_balance_providerpath"))
+
+    def degrade(self, steam_id, gametype):
+        """Gives a player the default rating while QLRanks can't be reached."""
+        self.degraded.add((steam_id, gametype))
+        self.set_rating(steam_id, gametype, self.get_cvar("qlx_balance_defaultrating"))
+        if not self.degraded_armed:
+            self.degraded_armed = True
+            self.degraded_tick()
+
+    @minqlx.delay(CIRCUIT_BACKOFF)
+    def degraded_tick(self):
+        """Looks the degraded players up again once the circuit lets a request through,
+        which also probes QLRanks if nothing else has. A failed probe degrades them
+        again, which schedules the next try."""
+        self.degraded_armed = False
+        if not self.degraded:
+            return
+        if self.circuit.available():
+            self.trace("lookup", TRACE_INFO, "retrying {} degraded ratings", len(self.degraded))
+            self.retry_degraded()
+        else:
+            self.degraded_armed = True
+            self.degraded_tick()
+
+    def retry_degraded(self):
+        """QLRanks is answering again, so look up the players who got a default rating
+        while it wasn't."""
+        degraded = self.degraded
+        self.degraded = set()
+        gametype = self.game.type_short
+        players = []
+        for steam_id, gt in degraded:
+            self.remove_rating(steam_id, gt)
+            if gt == gametype:
+                player = self.roster.player(steam_id)
+                if player:
+                    players.append(player)
+        if players:
+            self.fetch_rating(players, gametype, None)
 
-    def teams_info(self, channel, game_type):
-        self.info("teams_info")
+    def teams_info(self, channel, game_type, attempt=0):
+        self.trace("balance", TRACE_DEBUG, "teams_info")
         """Send average team ratings and an improvement suggestion to whoever asked for it.
         """
-        teams = self.teams()
+        teams = self.roster.teams()
         diff = len(teams["red"]) - len(teams["blue"])
         if diff:
             channel.reply("^7Both teams should have the same number of players.")
@@ -548,48 +1112,201 @@ class balance(minqlx.Plugin):
         players = teams["red"] + teams["blue"]
         for player in players:
             if not self.has_rating(player.steam_id, game_type):
-                self.console("need all elo for teams")
+                self.trace("balance", TRACE_INFO, "need all elo for teams")
                 self.fetch_rating(players, game_type, (self.teams_info, (channel, game_type)))
                 return
 
-        self.console("have all elo for teams")
+        self.trace("balance", TRACE_INFO, "have all elo for teams")
 
+        # Do the searches on a worker thread and come back once they're done.
+        count = self.get_cvar("qlx_balance_suggestions", int)
+        time_budget = self.get_cvar("qlx_balance_searchtime", int) / 1000
+        snapshot = self.snapshot(game_type, teams)
+        jobs = [(("switches", count), lambda s: find_switches(s, count)),
+                ("exchange", lambda s: find_exchange(s, time_budget))]
+        jobs = [job for job in jobs if not self.plan_known(job[0], snapshot)]
+        if jobs:
+            self.start_search(snapshot, jobs, channel, (self.teams_info, (channel, game_type)), attempt)
+            return True
 
-        avg_red = self.team_average(teams["red"], game_type)
-        avg_blue = self.team_average(teams["blue"], game_type)
-        switch = self.suggest_switch(teams, game_type)
-        diff = len(teams["red"]) - len(teams["blue"])
-        diff_rounded = abs(round(avg_red) - round(avg_blue)) # Round individual averages.
-        if round(avg_red) > round(avg_blue):
-            channel.reply("^1{} ^7vs ^4{}^7 - DIFFERENCE: ^1{}"
-                .format(round(avg_red), round(avg_blue), diff_rounded))
-        elif round(avg_red) < round(avg_blue):
-            channel.reply("^1{} ^7vs ^4{}^7 - DIFFERENCE: ^4{}"
-                .format(round(avg_red), round(avg_blue), diff_rounded))
-        else:
-            channel.reply("^1{} ^7vs ^4{}^7 - Holy shit!"
-                .format(round(avg_red), round(avg_blue)))
+        aggregate = self.team_ratings_for(game_type, teams)
+        avg_red = aggregate.average("red")
+        avg_blue = aggregate.average("blue")
+        channel.reply(self.format_averages(avg_red, avg_blue))
 
         minimum_suggestion_diff = self.get_cvar("qlx_balance_minimumsuggestiondifference", int)
+        switches = self.suggest_switches(teams, game_type, count)
+        switches = [s for s in switches if s[1] >= minimum_suggestion_diff and not self.involves_declined(s[0])]
+
+        # Single switches can't always fix teams with clustered ratings, so look
+        # for a bigger exchange if none of them is good enough.
+        exchange = False
+        if not switches:
+            switch = self.suggest_exchange(teams, game_type)
+            if switch and switch[1] >= minimum_suggestion_diff and not self.involves_declined(switch[0]):
+                switches = [switch]
+                exchange = True
 
-        if switch and switch[1] >= minimum_suggestion_diff:
-            channel.reply("^7SUGGESTION: switch ^6{}^7 with ^6{}^7. Type !a to agree."
-                .format(switch[0][0].clean_name, switch[0][1].clean_name))
-            if not self.suggested_pair or self.suggested_pair[0] != switch[0][0] or self.suggested_pair[1] != switch[0][1]:
-                self.suggested_pair = (switch[0][0], switch[0][1])
-                self.suggested_agree = [False, False]
+        if switches:
+            switch = switches[0]
+            channel.reply("^7SUGGESTION: switch {}. Type !a to agree."
+                .format(self.describe_switch(switch[0])))
+            if exchange:
+                avg_red, avg_blue = self.projected_averages(aggregate, switch[0])
+                channel.reply("^7Afterwards: " + self.format_averages(avg_red, avg_blue))
+            if len(switches) > 1:
+                channel.reply("^7Alternatives: {}. Type !decline to skip a suggestion."
+                    .format(", ".join(self.describe_switch(s[0]) for s in switches[1:])))
+            if self.suggested_switch != switch[0]:
+                self.set_suggestion(switch[0])
+            self.suggested_alternatives = switches[1:]
         else:
             i = random.randint(0, 99)
             if not i:
                 channel.reply("^7Teens look ^6good!")
             else:
                 channel.reply("^7Teams look good!")
-            self.suggested_pair = None
+            self.suggested_switch = None
+            self.suggested_agree = []
+            self.suggested_alternatives = []
 
         return True       
+
+    def format_averages(self, avg_red, avg_blue):
+        """The team averages and their difference the way !teams shows them."""
+        diff_rounded = abs(round(avg_red) - round(avg_blue)) # Round individual averages.
+        if round(avg_red) > round(avg_blue):
+            return ("^1{} ^7vs ^4{}^7 - DIFFERENCE: ^1{}"
+                .format(round(avg_red), round(avg_blue), diff_rounded))
+        elif round(avg_red) < round(avg_blue):
+            return ("^1{} ^7vs ^4{}^7 - DIFFERENCE: ^4{}"
+                .format(round(avg_red), round(avg_blue), diff_rounded))
+        else:
+            return ("^1{} ^7vs ^4{}^7 - Holy shit!"
+                .format(round(avg_red), round(avg_blue)))
+
+    def describe_switch(self, switch):
+        reds = " and ".join("^6{}^7".format(p.clean_name) for p in switch[0])
+        blues = " and ".join("^6{}^7".format(p.clean_name) for p in switch[1])
+        return "{} with {}".format(reds, blues)
+
+    def involves_declined(self, switch):
+        return any(p.steam_id in self.declined for p in switch[0] + switch[1])
+
+    def set_suggestion(self, switch):
+        self.suggested_switch = switch
+        self.suggested_agree = [False] * (len(switch[0]) + len(switch[1]))
+
+    def projected_averages(self, aggregate, switch):
+        """Team averages after the players of switch have changed teams."""
+        delta = (sum(aggregate.rating(p.steam_id) for p in switch[1]) -
+                 sum(aggregate.rating(p.steam_id) for p in switch[0]))
+        red_count = aggregate.counts["red"] - len(switch[0]) + len(switch[1])
+        blue_count = aggregate.counts["blue"] - len(switch[1]) + len(switch[0])
+        return ((aggregate.sums["red"] + delta) / red_count,
+                (aggregate.sums["blue"] - delta) / blue_count)
         
+    def team_ratings_for(self, game_type, teams=None):
+        """Returns the TeamRatings of the current teams, rebuilding them from the roster
+        if the gametype changed or they have gone out of sync with the given teams."""
+        aggregate = self.team_ratings
+        if aggregate and aggregate.gametype == game_type:
+            if not teams or aggregate.matches(teams):
+                return aggregate
+
+        if not teams:
+            teams = self.roster.teams()
+        aggregate = TeamRatings(game_type)
+        for team in ("red", "blue"):
+            for p in teams[team]:
+                aggregate.add(p.steam_id, team, self.get_rating(p.steam_id, game_type))
+        self.team_ratings = aggregate
+        return aggregate
+
+    def snapshot(self, game_type, teams):
+        """The teams and their ratings as a RosterSnapshot, for searching off the game
+        thread and as the key of the plans worked out for them. Each team is sorted by
+        steam_id, since the order teams() lists players in changes without anyone
+        moving, and the indices in plans are into these tuples rather than teams."""
+        aggregate = self.team_ratings_for(game_type, teams)
+        return RosterSnapshot(game_type,
+            tuple(sorted((p.steam_id, aggregate.rating(p.steam_id)) for p in teams["red"])),
+            tuple(sorted((p.steam_id, aggregate.rating(p.steam_id)) for p in teams["blue"])))
+
+    def plan(self, kind, snapshot, compute):
+        """The result of compute(snapshot). It's worked out once and then reused until
+        a team or a rating changes, so spamming !teams or !balance is cheap."""
+        if self.plan_known(kind, snapshot):
+            self.trace("balance", TRACE_DEBUG, "reusing the {} plan", kind)
+        else:
+            self.remember_plan(kind, snapshot, compute(snapshot))
+        return self.plans[kind]
+
+    def plan_known(self, kind, snapshot):
+        return snapshot == self.plans_key and kind in self.plans
+
+    def remember_plan(self, kind, snapshot, plan):
+        if snapshot != self.plans_key:
+            self.plans = {}
+            self.plans_key = snapshot
+        self.plans[kind] = plan
+
+    def forget_plans(self):
+        self.plans = {}
+        self.plans_key = None
+
+    def start_search(self, snapshot, jobs, channel, callback, attempt):
+        """Searches for the plans in jobs and runs callback once they're there. If
+        snapshot is already being searched, callback waits for that search instead,
+        and runs again to start its own if that one didn't cover its jobs."""
+        waiting = self.searches.get(snapshot)
+        if waiting is not None:
+            self.trace("balance", TRACE_DEBUG, "waiting for the running search")
+            waiting.append((channel, callback, attempt))
+            return
+        self.searches[snapshot] = [(channel, callback, attempt)]
+        self.search_plans(snapshot, jobs)
+
+    @minqlx.thread
+    def search_plans(self, snapshot, jobs):
+        """Works out the plans in jobs, a list of (kind, function of a snapshot), away
+        from the game thread. Only reads snapshot, so the server carries on meanwhile."""
+        start = time.monotonic()
+        try:
+            plans = [(kind, job(snapshot)) for kind, job in jobs]
+        except:
+            minqlx.log_exception(self)
+            plans = None
+        else:
+            if self.trace.enabled("balance", TRACE_DEBUG):
+                self.trace("balance", TRACE_DEBUG, "searched {} in {:.1f}ms", [kind for kind, job in jobs],
+                           (time.monotonic() - start) * 1000)
+        self.plans_found(snapshot, plans)
+
+    @minqlx.next_frame
+    def plans_found(self, snapshot, plans):
+        """Keeps the plans and runs the callbacks waiting for them again to act on them,
+        unless the teams changed while they were being worked out, in which case
+        they're useless."""
+        waiting = self.searches.pop(snapshot, [])
+        if plans is None:
+            for channel, callback, attempt in waiting:
+                channel.reply("^7Couldn't work out the teams, try again.")
+            return
+        if self.snapshot(snapshot.gametype, self.roster.teams()) != snapshot:
+            self.trace("balance", TRACE_INFO, "teams changed during the search")
+            for channel, callback, attempt in waiting:
+                if attempt >= 2:
+                    channel.reply("^7The teams keep changing, try again in a moment.")
+                else:
+                    callback[0](*callback[1], attempt=attempt + 1)
+            return
+        for kind, plan in plans:
+            self.remember_plan(kind, snapshot, plan)
+        for channel, callback, attempt in waiting:
+            callback[0](*callback[1])
+
     def team_average(self, team, game_type):
-        self.info("team_average")
         """Calculates the average rating of a team."""
         avg = 0
         
@@ -600,12 +1317,12 @@ class balance(minqlx.Plugin):
 
         return avg     
         
-    def average_balance(self, channel, game_type):
-        self.console("average_balance")
+    def average_balance(self, channel, game_type, attempt=0):
+        self.trace("balance", TRACE_DEBUG, "average_balance")
         """Balance teams based on average team ratings.
 
         """
-        teams = self.teams()
+        teams = self.roster.teams()
         total = len(teams["red"]) + len(teams["blue"])
         if total % 2 == 1:
             channel.reply("^7I can't balance when the total number of players isn't an even number.")
@@ -614,116 +1331,125 @@ class balance(minqlx.Plugin):
         players = teams["red"] + teams["blue"]
         for player in players:
             if not self.has_rating(player.steam_id, game_type):
-                self.console("need all elo for balance")
+                self.trace("balance", TRACE_INFO, "need all elo for balance")
                 self.fetch_rating(players, game_type, (self.average_balance, (channel, game_type)))
                 return
 
-        self.console("have all elo for balance")
-        
-        # Start out by evening out the number of players on each team.
-        diff = len(teams["red"]) - len(teams["blue"])
-        if abs(diff) > 1:
-            channel.reply("^7Evening teams...")
-            if diff > 0:
-                for i in range(diff - 1):
-                    p = teams["red"].pop()
-                    self.put(p, "blue")
-                    teams["blue"].append(p)
-            elif diff < 0:
-                for i in range(abs(diff) - 1):
-                    p = teams["blue"].pop()
-                    self.put(p, "red")
-                    teams["red"].append(p)
-
-        # Start shuffling by looping through our suggestion function until
-        # there are no more switches that can be done to improve teams.
-        switch = self.suggest_switch(teams, game_type)
-        if switch:
-            self.msg("^7Balancing teams...")
-            self.lock("red")
-            self.lock("blue")
-            while switch:
-                p1 = switch[0][0]
-                p2 = switch[0][1]
-                self.msg("^7{} ^6<=> ^7{}".format(p1, p2))
-                self.switch(p1, p2)
-                teams["blue"].append(p1)
-                teams["red"].append(p2)
-                teams["blue"].remove(p2)
-                teams["red"].remove(p1)
-                teams["red"].remove(p1)
-                switch = self.suggest_switch(teams, game_type)
-            self.unlock("red")
-            self.unlock("blue")
-            avg_red = self.team_average(teams["red"], game_type)
-            avg_blue = self.team_average(teams["blue"], game_type)
-            diff_rounded = abs(round(avg_red) - round(avg_blue)) # Round individual averages.
-            if round(avg_red) > round(avg_blue):
-                self.msg("^7Done! ^1{} ^7vs ^4{}^7 - DIFFERENCE: ^1{}"
-                    .format(round(avg_red), round(avg_blue), diff_rounded))
-            elif round(avg_red) < round(avg_blue):
-                self.msg("^7Done! ^1{} ^7vs ^4{}^7 - DIFFERENCE: ^4{}"
-                    .format(round(avg_red), round(avg_blue), diff_rounded))
-            else:
-                self.msg("^7Done! ^1{} ^7vs ^4{}^7 - Holy shit!"
-                    .format(round(avg_red), round(avg_blue)))
-        else:
+        self.trace("balance", TRACE_INFO, "have all elo for balance")
+
+        # Find the best possible split in one go rather than greedily switching
+        # pairs, which tends to get stuck on a local optimum.
+        snapshot = self.snapshot(game_type, teams)
+        if not self.plan_known("partition", snapshot):
+            time_budget = self.get_cvar("qlx_balance_searchtime", int) / 1000
+            self.start_search(snapshot, [("partition", lambda s: best_partition(s.ratings(), set(range(len(s.red))), time_budget))],
+                              channel, (self.average_balance, (channel, game_type)), attempt)
+            return True
+
+        # The partition's indices are into the snapshot, reds first.
+        by_steam_id = {p.steam_id: p for p in players}
+        players = [by_steam_id[steam_id] for steam_id, rating in snapshot.red + snapshot.blue]
+        ratings = snapshot.ratings()
+        red_count = len(snapshot.red)
+        cur_diff = abs(sum(ratings[:red_count]) - sum(ratings[red_count:]))
+        red_set, best_diff = self.plans["partition"]
+        if best_diff >= cur_diff and abs(red_count - len(teams["blue"])) < 2:
             channel.reply("^7Teams are good! Nothing to balance.")
+            return True
+
+        to_blue = [players[i] for i in range(red_count) if i not in red_set]
+        to_red = [players[i] for i in range(red_count, len(players)) if i in red_set]
+        if abs(len(to_blue) - len(to_red)) > 0:
+            channel.reply("^7Evening teams...")
+        self.msg("^7Balancing teams...")
+        self.lock("red")
+        self.lock("blue")
+        for p1, p2 in zip(to_blue, to_red):
+            self.msg("^7{} ^6<=> ^7{}".format(p1, p2))
+            self.switch(p1, p2)
+        # Whatever is left over evens out the number of players on each team.
+        for p in to_blue[len(to_red):]:
+            self.put(p, "blue")
+        for p in to_red[len(to_blue):]:
+            self.put(p, "red")
+        self.unlock("red")
+        self.unlock("blue")
+
+        # The team_switch events may not have come in yet, so report on the plan itself.
+        red_sum = sum(ratings[i] for i in red_set)
+        avg_red = red_sum / len(red_set)
+        avg_blue = (sum(ratings) - red_sum) / (len(players) - len(red_set))
+        self.msg("^7Done! " + self.format_averages(avg_red, avg_blue))
         return True
             
     def suggest_switch(self, teams, game_type):
-        self.info("suggest_switch")
+        self.trace("balance", TRACE_DEBUG, "suggest_switch")
         """Suggest a switch based on average team ratings.
 
         """
-        avg_red = self.team_average(teams["red"], game_type)
-        avg_blue = self.team_average(teams["blue"], game_type)
-        cur_diff = abs(avg_red - avg_blue)
-        min_diff = 999999
-        best_pair = None
-
-        for red_p in teams["red"]:
-            for blue_p in teams["blue"]:
-                r = teams["red"].copy()
-                b = teams["blue"].copy()
-                b.append(red_p)
-                r.remove(red_p)
-                r.append(blue_p)
-                b.remove(blue_p)
-                avg_red = self.team_average(r, game_type)
-                avg_blue = self.team_average(b, game_type)
-                diff = abs(avg_red - avg_blue)
-                if diff < min_diff:
-                    min_diff = diff
-                    best_pair = (red_p, blue_p)
-
-        if min_diff < cur_diff:
-            return (best_pair, cur_diff - min_diff)
+        switches = self.suggest_switches(teams, game_type, 1)
+        if switches:
+            return switches[0]
         else:
-            return None       
-                
+            return None
+
+    def suggest_switches(self, teams, game_type, count):
+        """Up to count switches that improve the average team ratings, best first,
+        as a list of ((red_player, blue_player), improvement)."""
+        if not teams["red"] or not teams["blue"] or count < 1:
+            return []
+
+        snapshot = self.snapshot(game_type, teams)
+        switches = self.plan(("switches", count), snapshot, lambda s: find_switches(s, count))
+        return [(self.switch_players(teams, snapshot, switch), improvement) for switch, improvement in switches]
+
+    def suggest_exchange(self, teams, game_type):
+        """The best exchange of up to two players per team found within qlx_balance_searchtime
+        milliseconds, as ((red players, blue players), improvement), or None."""
+        if not teams["red"] or not teams["blue"]:
+            return None
+
+        time_budget = self.get_cvar("qlx_balance_searchtime", int) / 1000
+        snapshot = self.snapshot(game_type, teams)
+        exchange = self.plan("exchange", snapshot, lambda s: find_exchange(s, time_budget))
+        if not exchange:
+            return None
+        return (self.switch_players(teams, snapshot, exchange[0]), exchange[1])
+
+    def switch_players(self, teams, snapshot, switch):
+        """The players of teams in a switch given as (red indices, blue indices) into snapshot."""
+        players = {p.steam_id: p for p in teams["red"] + teams["blue"]}
+        return (tuple(players[snapshot.red[i][0]] for i in switch[0]),
+                tuple(players[snapshot.blue[i][0]] for i in switch[1]))
+
     def execute_suggestion(self):
-        self.info("execute_suggestion")
-        self.switch(self.suggested_pair[0], self.suggested_pair[1])
-        self.suggested_pair = None
-        self.suggested_agree = [False, False]
+        self.trace("balance", TRACE_DEBUG, "execute_suggestion")
+        reds, blues = self.suggested_switch
+        for p1, p2 in zip(reds, blues):
+            self.switch(p1, p2)
+        for p in reds[len(blues):]:
+            self.put(p, "blue")
+        for p in blues[len(reds):]:
+            self.put(p, "red")
+        self.suggested_switch = None
+        self.suggested_agree = []
+        self.suggested_alternatives = []
 
     def flag_player(self, player):
-        self.info("flag_player")
+        self.trace("requirements", TRACE_DEBUG, "flag_player")
         if player not in self.ban_flagged:
             self.ban_flagged.append(player)
     
     def unflag_player(self, player):
-        self.info("unflag_player")
+        self.trace("requirements", TRACE_DEBUG, "unflag_player")
         if player in self.ban_flagged:
             self.ban_flagged.remove(player)
 
     def is_flagged(self, player):
-        self.info("is_flagged")
         return player in self.ban_flagged        
         
     def check_rating_requirements(self, player, game_type, new_team="spectator", old_team=""):
-        self.info("check_rating_requirements")
+        self.trace("requirements", TRACE_DEBUG, "check_rating_requirements")
         """Checks if someone meets the rating requirements to play on the server."""
         min_rating = self.get_cvar("qlx_balance_minimumrating", int)
         max_rating = self.get_cvar("qlx_balance_maximumrating", int)
@@ -766,39 +1492,63 @@ class balance(minqlx.Plugin):
 
         return True
     
-    @minqlx.delay(1)
-    def tell_spec(self, player, time=0):
-        self.info("tell_spec")
-        player.update()
-        if player:
-            if player.steam_id in self.loaded_players: # player is connected and should receive tell
-                player.tell("^7Sorry, but you need at least ^6{}^7 rating to play here and you are not yet ranked.".format(self.get_cvar("qlx_balance_minimumrating", int)))
-                player.tell("^7Type '^6!iam ^2<Your-old-Quakelive-Nick>^7' to get a Rating.")
-            else:
-                time+=1
-                if time<20:
-                    self.tell_spec(player, time)
-        
-    @minqlx.delay(5)
-    def tell_kick(self, player, told=False, time=0, kicktime = 40):
-        self.info("tell_kick {}".format(time))
-        player.update()
-        if player:
-            if player.steam_id in self.loaded_players and not (told or time == kicktime - 10): # player is connected and should receive tell
-                if not told:
-                    kicktime = time + 20
-                player.tell("^7You do not meet the rating requirements on this server. You will be kicked shortly.")
-                told = True
-            if time >= kicktime:
-                player.ban()
-                player.kick()
-                return
-        time += 5
-        if time <= kicktime:
-            self.tell_kick(player, told, time, kicktime)
+    def tell_spec(self, player):
+        """Tells an unranked spectator how to get a rating, once they've loaded."""
+        self.trace("requirements", TRACE_DEBUG, "tell_spec")
+        if player.steam_id in self.loaded_players:
+            self.deliver_tell(player, "spec")
+        else:
+            self.pending_tells[player.steam_id] = "spec"
+            self.schedule_requirement(player.steam_id, "notify", NOTIFY_TIMEOUT)
+
+    def tell_kick(self, player):
+        """Warns a player not meeting the requirements once they've loaded, then kickbans
+        them KICK_AFTER_TELL seconds later, or KICK_DELAY seconds from now at the latest."""
+        self.trace("requirements", TRACE_DEBUG, "tell_kick")
+        self.schedule_requirement(player.steam_id, "kick", KICK_DELAY)
+        if player.steam_id in self.loaded_players:
+            self.deliver_tell(player, "kick")
+        else:
+            self.pending_tells[player.steam_id] = "kick"
+            self.schedule_requirement(player.steam_id, "notify", NOTIFY_TIMEOUT)
+
+    def deliver_tell(self, player, kind):
+        self.requirements.cancel(player.steam_id, "notify")
+        if kind == "spec":
+            player.tell("^7Sorry, but you need at least ^6{}^7 rating to play here and you are not yet ranked.".format(self.get_cvar("qlx_balance_minimumrating", int)))
+            player.tell("^7Type '^6!iam ^2<Your-old-Quakelive-Nick>^7' to get a Rating.")
+        elif kind == "kick":
+            player.tell("^7You do not meet the rating requirements on this server. You will be kicked shortly.")
+            remaining = self.requirements.remaining(player.steam_id, "kick")
+            if remaining is not None and remaining * REQUIREMENTS_TICK > KICK_AFTER_TELL:
+                self.schedule_requirement(player.steam_id, "kick", KICK_AFTER_TELL)
+
+    def schedule_requirement(self, steam_id, kind, delay):
+        self.requirements.add(steam_id, kind, -(-delay // REQUIREMENTS_TICK))
+        if not self.requirements_armed:
+            self.requirements_armed = True
+            self.requirements_tick()
+
+    @minqlx.delay(REQUIREMENTS_TICK)
+    def requirements_tick(self):
+        self.requirements_armed = False
+        due = self.requirements.advance()
+        if due:
+            self.trace("requirements", TRACE_DEBUG, "requirements_tick {}", due)
+        for steam_id, kind in due:
+            if kind == "notify": # never finished loading, drop the tell
+                self.pending_tells.pop(steam_id, None)
+            elif kind == "kick":
+                self.pending_tells.pop(steam_id, None)
+                player = self.roster.player(steam_id)
+                if player:
+                    player.ban()
+                    player.kick()
+        if self.requirements:
+            self.requirements_armed = True
+            self.requirements_tick()
         
     def check_input(self, msg, player, max = 2, min = 1, pos = 1):
-        self.info("check_input")
         if len(msg) < min:
             return (minqlx.RET_USAGE, None)
         if len(msg) > max:
@@ -818,82 +1568,1200 @@ class balance(minqlx.Plugin):
         return (False, target_player)
         
     def testnick(self, player, nick, force=False):
-        qlranks_key = _quakelive_key.format(player.steam_id)
-        if qlranks_key in self.db and not force:
-            self.msg("{}'s old quakelive-Nick is already set to {}.".format(player.name, self.db[qlranks_key]))
+        old_nick = self.read_profiles([player.steam_id])[player.steam_id].get("nick")
+        if old_nick is not None and not force:
+            self.msg("{}'s old quakelive-Nick is already set to {}.".format(player.name, old_nick))
             return
         self.remove_rating(player.steam_id, self.game.type_short)
-        self.fetch_rating([player], self.game.type_short, (self.setnick, (player, nick)), 0, nick)
+        self.fetch_rating([player], self.game.type_short, (self.setnick, (player, nick)), nick)
         
     def setnick(self, player, nick):
-        if nick in self.lookup_nicks and self.lookup_nicks[nick][1] == "found":
-            qlranks_key = _quakelive_key.format(player.steam_id)
-            self.db[qlranks_key] = nick
+        if nick in self.lookup_nicks and self.lookup_nicks[nick].status == "found":
+            self.store_profile(player.steam_id, "nick", nick)
             self.msg("{}'s old quakelive-Nick is set to {}.".format(player.name, nick))
         else:
             self.msg("{} was not found.".format(nick))
         
-    def info(self, info):
-        self.console(info)
-        return
+    def cmd_trace(self, player, msg, channel):
+        """Sets the trace level of a subsystem, or of all of them, optionally recording
+        only every nth message."""
+        if len(msg) < 3 or msg[2] not in TRACE_LEVELS:
+            channel.reply("^7Subsystems: {}. Levels: {}.".format(", ".join(TRACE_SUBSYSTEMS), ", ".join(TRACE_LEVELS)))
+            return minqlx.RET_USAGE
+        subsystems = TRACE_SUBSYSTEMS if msg[1] == "all" else (msg[1],)
+        if subsystems[0] not in TRACE_SUBSYSTEMS:
+            return minqlx.RET_USAGE
+        try:
+            sample = int(msg[3]) if len(msg) > 3 else 1
+        except ValueError:
+            return minqlx.RET_USAGE
+        for subsystem in subsystems:
+            self.trace.set_level(subsystem, TRACE_LEVELS[msg[2]], sample)
+        channel.reply("^7Tracing {} at {}.".format(msg[1], msg[2]))
+
+    def cmd_ratingstats(self, player, msg, channel):
+        """Shows how long each stage of getting a player's rating takes, or writes
+        it to the console as JSON."""
+        summary = self.latency.summary()
+        if len(msg) > 1 and msg[1] == "json":
+            self.console("balance latency: " + json.dumps(summary, sort_keys=True))
+            channel.reply("^7Latency summary written to the server console.")
+            return
+        if not summary:
+            channel.reply("^7No latency samples yet.")
+        for stage in LATENCY_STAGES:
+            if stage in summary:
+                s = summary[stage]
+                channel.reply("^7{}: ^6{}^7 samples, p50 ^6{}^7ms, p95 ^6{}^7ms, p99 ^6{}^7ms, max ^6{}^7ms."
+                    .format(stage, s["count"], s["p50"], s["p95"], s["p99"], s["max"]))
+
+    def cmd_tracedump(self, player, msg, channel):
+        """Shows the last lines of the trace buffer."""
+        try:
+            count = int(msg[1]) if len(msg) > 1 else 10
+        except ValueError:
+            return minqlx.RET_USAGE
+        lines = self.trace.dump(count)
+        if not lines:
+            channel.reply("^7The trace buffer is empty.")
+        for line in lines:
+            channel.reply(line)
+
+    def cmd_migrateratings(self, player, msg, channel):
+        """Moves the ratings and nicks stored under the old one-key-per-value layout
+        into the profile hashes, in the background. Safe to run while people play
+        and to run again."""
+        if self.migrating:
+            channel.reply("^7The migration is already running.")
+            return
+        self.migrating = True
+        channel.reply("^7Migrating the stored ratings...")
+        self.migrate_ratings(channel)
+
+    @minqlx.thread
+    def migrate_ratings(self, channel):
+        pattern = re.compile(r"^minqlx:players:(\d+):(?:rating:\w+|old_quakelive_nick)$")
+        fields = ELO_GAMETYPES + ("nick",)
+        seen = set()
+        batch = []
+        migrated = 0
+        try:
+            for key in self.db.scan_iter(match="minqlx:players:*", count=1000):
+                match = pattern.match(key)
+                if not match or match.group(1) in seen:
+                    continue
+                seen.add(match.group(1))
+                batch.append(int(match.group(1)))
+                if len(batch) >= MIGRATION_BATCH:
+                    migrated += self.migrate_batch(batch, fields)
+                    batch = []
+                    self.migration_progress(channel, "^7Migrated ^6{}^7 players so far...".format(migrated))
+            if batch:
+                migrated += self.migrate_batch(batch, fields)
+            self.db[_profiles_migrated_key] = 1
+        except Exception:
+            minqlx.log_exception(self)
+            self.migration_progress(channel, "^7The migration failed after ^6{}^7 players, run it again to carry on.".format(migrated), True)
+            return
+        self.migration_progress(channel, "^7Done, migrated ^6{}^7 players.".format(migrated), True, True)
+
+    def migrate_batch(self, steam_ids, fields):
+        """Copies the old keys of steam_ids into their profiles and deletes them, in one
+        transaction per batch. Fields the profile already has are newer and kept."""
+        keys = [old_profile_key(sid, field) for sid in steam_ids for field in fields]
+        values = self.db.mget(keys)
+        pipe = self.db.pipeline()
+        for i, steam_id in enumerate(steam_ids):
+            profile_key = _profile_key.format(steam_id)
+            for j, field in enumerate(fields):
+                value = values[i * len(fields) + j]
+                if value is not None:
+                    pipe.hsetnx(profile_key, field, value)
+            pipe.hset(profile_key, "migrated", 1)
+        pipe.delete(*keys)
+        pipe.execute()
+        return len(steam_ids)
+
+    @minqlx.next_frame
+    def migration_progress(self, channel, message, done=False, complete=False):
+        if done:
+            self.migrating = False
+        if complete:
+            self.profiles_migrated = True
+        channel.reply(message)
+
+
+class Tracer:
+    """Leveled and sampled tracing into a ring buffer. Calls for a subsystem that isn't
+    traced return after a single dict lookup, and messages are only formatted once
+    we know they're kept. Arguments that are costly to build go behind enabled()."""
+    def __init__(self, size=TRACE_BUFFER_SIZE):
+        # Keys: subsystem - Items: trace level
+        self.levels = {}
+        # Keys: subsystem - Items: (keep every nth message, messages seen)
+        self.sampling = {}
+        self.buffer = collections.deque(maxlen=size)
+
+    def set_level(self, subsystem, level, sample=1):
+        if level == TRACE_OFF:
+            self.levels.pop(subsystem, None)
+        else:
+            self.levels[subsystem] = level
+        self.sampling[subsystem] = [max(sample, 1), 0]
+
+    def enabled(self, subsystem, level):
+        return self.levels.get(subsystem, TRACE_OFF) >= level
+
+    def __call__(self, subsystem, level, fmt, *args):
+        if self.levels.get(subsystem, TRACE_OFF) < level:
+            return
+        sampling = self.sampling[subsystem]
+        sampling[1] += 1
+        if sampling[1] % sampling[0]:
+            return
+        self.buffer.append("{} [{}] {}".format(datetime.datetime.now().strftime("%H:%M:%S.%f")[:-3],
+            subsystem, fmt.format(*args)))
+
+    def dump(self, count):
+        return list(self.buffer)[-count:]
+
+
+class LatencyStats:
+    """The last LATENCY_SAMPLES durations of each stage, with percentile summaries."""
+    def __init__(self, size=LATENCY_SAMPLES):
+        self.size = size
+        self.lock = threading.Lock()
+        # Keys: stage - Items: deque of durations in seconds
+        self.samples = {}
+
+    def record(self, stage, seconds):
+        with self.lock:
+            if stage not in self.samples:
+                self.samples[stage] = collections.deque(maxlen=self.size)
+            self.samples[stage].append(seconds)
+
+    def summary(self):
+        """Returns {stage: {"count", "p50", "p95", "p99", "max"}}, times in milliseconds."""
+        with self.lock:
+            samples = {stage: sorted(values) for stage, values in self.samples.items()}
+        summary = {}
+        for stage, values in samples.items():
+            def percentile(p):
+                return round(values[min(len(values) - 1, int(p / 100 * len(values)))] * 1000, 1)
+            summary[stage] = {"count": len(values), "p50": percentile(50), "p95": percentile(95),
+                              "p99": percentile(99), "max": round(values[-1] * 1000, 1)}
+        return summary
+
+
+class RatingWaiter:
+    """A callback waiting for a set of (steam_id, gametype) ratings to be set."""
+    def __init__(self, keys, callback):
+        self.keys = frozenset(keys)
+        self.pending = set(keys)
+        self.callback = callback
+
+
+class TeamRatings:
+    """Running rating sums and player counts of red and blue for a single gametype,
+    kept up to date from hooks so that team averages and swap deltas are plain
+    arithmetic instead of a walk over the roster."""
+    def __init__(self, gametype):
+        self.gametype = gametype
+        # Keys: steam_id - Items: [team, rating]
+        self.members = {}
+        self.sums = {"red": 0, "blue": 0}
+        self.counts = {"red": 0, "blue": 0}
+
+    def add(self, steam_id, team, rating):
+        self.remove(steam_id)
+        if team in self.sums:
+            self.members[steam_id] = [team, rating]
+            self.sums[team] += rating
+            self.counts[team] += 1
+
+    def remove(self, steam_id):
+        if steam_id in self.members:
+            team, rating = self.members.pop(steam_id)
+            self.sums[team] -= rating
+            self.counts[team] -= 1
+
+    def update(self, steam_id, rating):
+        if steam_id in self.members:
+            member = self.members[steam_id]
+            self.sums[member[0]] += rating - member[1]
+            member[1] = rating
+
+    def rating(self, steam_id):
+        return self.members[steam_id][1]
+
+    def matches(self, teams):
+        """Whether exactly the players of teams are on red and blue here, each on the
+        same team. A missed hook shows up as a mismatch rather than a KeyError later."""
+        if self.counts["red"] != len(teams["red"]) or self.counts["blue"] != len(teams["blue"]):
+            return False
+        return all(self.members.get(p.steam_id, (None,))[0] == team
+                   for team in ("red", "blue") for p in teams[team])
+
+    def average(self, team):
+        if not self.counts[team]:
+            return 0
+        return self.sums[team] / self.counts[team]
+
+
+class Roster:
+    """The players on the server by steam_id, by normalized clean name and by team,
+    built from a single teams() call. The plugin moves players around in it from
+    the hooks and throws it away every frame."""
+    TEAMS = ("red", "blue", "free", "spectator")
+
+    def __init__(self, teams):
+        # Keys: steam_id - Items: (player, team)
+        self.by_steam_id = {}
+        # Keys: normalized clean name - Items: steam_id
+        self.by_name = {}
+        # Keys: team - Items: {steam_id: player}
+        self.by_team = {team: {} for team in Roster.TEAMS}
+        for team in Roster.TEAMS:
+            for player in teams.get(team, ()):
+                self.add(player, team)
+
+    def __contains__(self, steam_id):
+        return steam_id in self.by_steam_id
+
+    def __len__(self):
+        return len(self.by_steam_id)
+
+    def add(self, player, team):
+        self.remove(player.steam_id)
+        self.by_steam_id[player.steam_id] = (player, team)
+        self.by_team.setdefault(team, {})[player.steam_id] = player
+        name = normalize_name(player.clean_name)
+        if name:
+            self.by_name[name] = player.steam_id
+
+    def remove(self, steam_id):
+        if steam_id not in self.by_steam_id:
+            return
+        player, team = self.by_steam_id.pop(steam_id)
+        del self.by_team[team][steam_id]
+        name = normalize_name(player.clean_name)
+        if self.by_name.get(name) == steam_id:
+            del self.by_name[name]
+
+    def _steam_id(self, key):
+        if isinstance(key, str):
+            return self.by_name.get(normalize_name(key))
+        return key
+
+    def player(self, key):
+        """The player with steam_id or clean name key, or None."""
+        entry = self.by_steam_id.get(self._steam_id(key))
+        return entry[0] if entry else None
+
+    def team_of(self, key):
+        """The team of the player with steam_id or clean name key, or None."""
+        entry = self.by_steam_id.get(self._steam_id(key))
+        return entry[1] if entry else None
+
+    def teams(self):
+        """Lists of players by team, like Plugin.teams()."""
+        return {team: list(self.by_team[team].values()) for team in Roster.TEAMS}
+
+
+def old_profile_key(steam_id, field):
+    """The key a profile field was stored under before the profile hashes."""
+    if field == "nick":
+        return _quakelive_key.format(steam_id)
+    return _rating_gametype_key.format(steam_id, field)
+
+
+def normalize_name(name):
+    return minqlx.clean_text(name or "").lower()
+
+
+def elo_update(ratings, k, reds, score):
+    """New ratings after a team result, as an array. ratings and k hold the reds first,
+    then the blues, and each team plays as its average rating. score is 1 for a red
+    win, 0 for a blue win and 0.5 for a draw."""
+    count = len(ratings)
+    red_average = sum(ratings[:reds]) / reds
+    blue_average = sum(ratings[reds:]) / (count - reds)
+    delta = score - 1 / (1 + 10 ** ((blue_average - red_average) / 400))
+    new_ratings = array("d", ratings)
+    for i in range(count):
+        new_ratings[i] += k[i] * (delta if i < reds else -delta)
+    return new_ratings
+
+
+class RosterSnapshot(collections.namedtuple("RosterSnapshot", "gametype red blue")):
+    """The teams at one point in time, red and blue being tuples of (steam_id, rating).
+    Being immutable, it's safe to search on from another thread."""
+    __slots__ = ()
+
+    def red_ratings(self):
+        return [rating for steam_id, rating in self.red]
+
+    def blue_ratings(self):
+        return [rating for steam_id, rating in self.blue]
+
+    def ratings(self):
+        """All ratings, reds first."""
+        return self.red_ratings() + self.blue_ratings()
+
+
+def find_switches(snapshot, count):
+    """Up to count switches of one red with one blue player that improve the average
+    team ratings, best first, as a list of (((red index,), (blue index,)), improvement)."""
+    if not snapshot.red or not snapshot.blue:
+        return []
+    red_ratings, blue_ratings = snapshot.red_ratings(), snapshot.blue_ratings()
+    red_sum, blue_sum = sum(red_ratings), sum(blue_ratings)
+    cur_diff = abs(red_sum / len(red_ratings) - blue_sum / len(blue_ratings))
+    return [(((r,), (b,)), cur_diff - diff)
+            for diff, r, b in best_swaps(red_ratings, blue_ratings, red_sum, blue_sum, count)
+            if diff < cur_diff]
+
+
+def find_exchange(snapshot, time_budget):
+    """The best exchange of up to two players per team found within time_budget
+    seconds, as ((red indices, blue indices), improvement), or None."""
+    if not snapshot.red or not snapshot.blue:
+        return None
+    red_ratings, blue_ratings = snapshot.red_ratings(), snapshot.blue_ratings()
+    red_sum, blue_sum = sum(red_ratings), sum(blue_ratings)
+    cur_diff = abs(red_sum / len(red_ratings) - blue_sum / len(blue_ratings))
+    diff, reds, blues = search_exchanges(red_ratings, blue_ratings, red_sum, blue_sum, time_budget)
+    if not reds or diff >= cur_diff:
+        return None
+    return ((tuple(reds), tuple(blues)), cur_diff - diff)
+
+
+def best_swaps(red_ratings, blue_ratings, red_sum, blue_sum, count):
+    """Scores switching every red player with every blue player in one pass and
+    returns the count best as (resulting average difference, red index, blue index),
+    best first. Uses NumPy when it's available.
+
+    """
+    red_count, blue_count = len(red_ratings), len(blue_ratings)
+    if numpy is not None:
+        red = numpy.asarray(red_ratings, dtype=float)
+        blue = numpy.asarray(blue_ratings, dtype=float)
+        delta = blue[numpy.newaxis, :] - red[:, numpy.newaxis]
+        diffs = numpy.abs((red_sum + delta) / red_count - (blue_sum - delta) / blue_count).ravel()
+        count = min(count, diffs.size)
+        best = numpy.argpartition(diffs, count - 1)[:count]
+        best = best[numpy.argsort(diffs[best], kind="stable")]
+        return [(float(diffs[i]), int(i) // blue_count, int(i) % blue_count) for i in best]
+
+    scores = ((abs((red_sum + b - a) / red_count - (blue_sum - b + a) / blue_count), r, j)
+              for r, a in enumerate(red_ratings) for j, b in enumerate(blue_ratings))
+    return heapq.nsmallest(count, scores)
+
+def search_exchanges(red_ratings, blue_ratings, red_sum, blue_sum, time_budget):
+    """Searches the exchanges in EXCHANGE_SIZES for the one that leaves the smallest
+    difference in average team rating, giving up after time_budget seconds.
+
+    Returns (resulting average difference, red indices, blue indices). The indices
+    are empty if nothing beats the current teams.
+
+    """
+    deadline = time.perf_counter() + time_budget
+    red_count, blue_count = len(red_ratings), len(blue_ratings)
+    best = (abs(red_sum / red_count - blue_sum / blue_count), (), ())
+
+    for red_size, blue_size in EXCHANGE_SIZES:
+        new_red = red_count - red_size + blue_size
+        new_blue = blue_count - blue_size + red_size
+        if red_size > red_count or blue_size > blue_count:
+            continue
+
+        reds = sorted((sum(red_ratings[i] for i in group), group)
+            for group in itertools.combinations(range(red_count), red_size))
+        blues = sorted((sum(blue_ratings[i] for i in group), group)
+            for group in itertools.combinations(range(blue_count), blue_size))
+        blue_keys = [s for s, _ in blues]
+
+        # The new difference is linear in the rating moved to red, d = blue group - red group,
+        # so for each red group only the blue groups around the zero crossing need checking.
+        base = red_sum / new_red - blue_sum / new_blue
+        slope = 1 / new_red + 1 / new_blue
+        target = -base / slope
+        for red_group_sum, red_group in reds:
+            if time.perf_counter() > deadline:
+                return best
+            pos = bisect.bisect_left(blue_keys, red_group_sum + target)
+            for i in (pos - 1, pos):
+                if 0 <= i < len(blues):
+                    diff = abs(base + (blue_keys[i] - red_group_sum) * slope)
+                    if diff < best[0]:
+                        best = (diff, red_group, blues[i][1])
+            if best[0] == 0:
+                return best
+
+    return best
+
+def _subset_sums(ratings):
+    """Sums of every subset of ratings, grouped by subset size. Each group is a
+    sorted list of (sum, mask) tuples."""
+    sums = [0] * (1 << len(ratings))
+    by_size = [[] for _ in range(len(ratings) + 1)]
+    by_size[0].append((0, 0))
+    for mask in range(1, 1 << len(ratings)):
+        low = mask & -mask
+        sums[mask] = sums[mask ^ low] + ratings[low.bit_length() - 1]
+        by_size[bin(mask).count("1")].append((sums[mask], mask))
+    for group in by_size:
+        group.sort()
+    return by_size
+
+def partition_exact(ratings):
+    """Meet-in-the-middle search for the split of ratings into two equally sized
+    halves with the smallest difference in rating sums.
+
+    Returns (set of indices of the first half, absolute sum difference).
+
+    """
+    n = len(ratings)
+    half = n // 2
+    total = sum(ratings)
+    mid = n // 2
+    left = _subset_sums(ratings[:mid])
+    right = _subset_sums(ratings[mid:])
+    right_keys = [[s for s, _ in group] for group in right]
+
+    best_diff = None
+    best = (0, 0)
+    for k in range(min(half, mid) + 1):
+        j = half - k
+        if j > n - mid:
+            continue
+        keys = right_keys[j]
+        for lsum, lmask in left[k]:
+            # Closest right-hand sum to what would put this half at total/2.
+            want = total / 2 - lsum
+            pos = bisect.bisect_left(keys, want)
+            for i in (pos - 1, pos):
+                if 0 <= i < len(keys):
+                    diff = abs(total - 2 * (lsum + keys[i]))
+                    if best_diff is None or diff < best_diff:
+                        best_diff = diff
+                        best = (lmask, right[j][i][1])
+            if best_diff == 0:
+                break
+        if best_diff == 0:
+            break
+
+    lmask, rmask = best
+    first = {i for i in range(mid) if lmask >> i & 1}
+    first |= {mid + i for i in range(n - mid) if rmask >> i & 1}
+    return first, best_diff
+
+def partition_heuristic(ratings, time_budget=PARTITION_TIME_BUDGET, current=frozenset()):
+    """Split of ratings into two equally sized halves, refined by pairwise swaps
+    until nothing improves or time_budget seconds have passed. The swaps start
+    from current (a set of indices) if it's a half, so that only the players
+    they touch move, and from a greedy split otherwise.
+
+    Returns (set of indices of the first half, absolute sum difference).
+
+    """
+    deadline = time.perf_counter() + time_budget
+    n = len(ratings)
+    half = n // 2
+    first, second = [], []
+    sum_first = sum_second = 0
+    if len(current) == half:
+        for i in range(n):
+            if i in current:
+                first.append(i)
+                sum_first += ratings[i]
+            else:
+                second.append(i)
+                sum_second += ratings[i]
+    else:
+        for i in sorted(range(n), key=lambda i: ratings[i], reverse=True):
+            if len(second) >= n - half or (len(first) < half and sum_first <= sum_second):
+                first.append(i)
+                sum_first += ratings[i]
+            else:
+                second.append(i)
+                sum_second += ratings[i]
+
+    diff = sum_first - sum_second
+    improved = True
+    while improved and diff and time.perf_counter() < deadline:
+        improved = False
+        best = abs(diff)
+        best_pair = None
+        for a in range(len(first)):
+            ra = ratings[first[a]]
+            for b in range(len(second)):
+                new = abs(diff - 2 * (ra - ratings[second[b]]))
+                if new < best:
+                    best = new
+                    best_pair = (a, b)
+        if best_pair:
+            a, b = best_pair
+            diff -= 2 * (ratings[first[a]] - ratings[second[b]])
+            first[a], second[b] = second[b], first[a]
+            improved = True
+
+    return set(first), abs(diff)
+
+def best_partition(ratings, current=frozenset(), time_budget=PARTITION_TIME_BUDGET):
+    """Best equally sized split of ratings. Of the two equivalent labellings the
+    one closest to the current assignment (a set of indices) is returned, so that
+    as few players as possible have to be moved.
+
+    Returns (set of indices, absolute sum difference).
+
+    """
+    if len(ratings) <= EXACT_PARTITION_LIMIT:
+        first, diff = partition_exact(ratings)
+    else:
+        first, diff = partition_heuristic(ratings, time_budget, current)
+
+    if len(ratings) % 2 == 0:
+        other = set(range(len(ratings))) - first
+        if len(first ^ current) > len(other ^ current):
+            first = other
+    return first, diff
 
 
 
         
     
-class DataGrabber(threading.Thread):
+class TimerWheel:
+    """Deadlines, counted in ticks, for a few kinds of event per key. Adding and
+    cancelling are O(1) and advance() hands back everything due in one batch.
+    Deadlines more than a lap of the wheel away wait in their slot for another lap."""
+
+    def __init__(self, slots=TIMER_WHEEL_SLOTS):
+        self.tick = 0
+        self.slots = [set() for _ in range(slots)]
+        # Keys: key - Items: {kind: tick it's due}
+        self.deadlines = {}
+
+    def __len__(self):
+        return len(self.deadlines)
+
+    def add(self, key, kind, ticks):
+        """Sets the deadline of kind for key to ticks from now, replacing any earlier one."""
+        due = self.tick + max(1, ticks)
+        self.deadlines.setdefault(key, {})[kind] = due
+        self.slots[due % len(self.slots)].add((key, kind))
+
+    def remaining(self, key, kind):
+        """Ticks until kind is due for key, or None if it isn't pending."""
+        due = self.deadlines.get(key, {}).get(kind)
+        return None if due is None else due - self.tick
+
+    def cancel(self, key, kind=None):
+        """Drops the deadline of kind for key, or all of key's. Their slot entries are
+        cleaned up when the wheel comes around to them."""
+        if kind is None:
+            self.deadlines.pop(key, None)
+        elif key in self.deadlines:
+            self.deadlines[key].pop(kind, None)
+            if not self.deadlines[key]:
+                del self.deadlines[key]
+
+    def advance(self):
+        """Moves on by a tick and returns the (key, kind) pairs that are due."""
+        self.tick += 1
+        slot = self.slots[self.tick % len(self.slots)]
+        due = []
+        for key, kind in list(slot):
+            when = self.deadlines.get(key, {}).get(kind)
+            if when == self.tick:
+                due.append((key, kind))
+                self.cancel(key, kind)
+            elif when is not None and when > self.tick and when % len(self.slots) == self.tick % len(self.slots):
+                continue # a later lap
+            slot.discard((key, kind))
+        return due
+
+
+class LRUCache:
+    """A dict-like cache that holds at most size entries, each for at most ttl seconds,
+    and drops the least recently used entry to make room for a new one. Membership
+    tests and get() are counted as hits and misses."""
+    def __init__(self, size, ttl):
+        self.size = size
+        self.ttl = ttl
+        # Keys: key - Items: (expiry time, value), least recently used first
+        self.data = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def _entry(self, key):
+        entry = self.data.get(key)
+        if entry is None:
+            return None
+        if entry[0] < time.monotonic():
+            del self.data[key]
+            self.expirations += 1
+            return None
+        self.data.move_to_end(key)
+        return entry
+
+    def __contains__(self, key):
+        if self._entry(key) is None:
+            self.misses += 1
+            return False
+        self.hits += 1
+        return True
+
+    def __getitem__(self, key):
+        entry = self._entry(key)
+        if entry is None:
+            raise KeyError(key)
+        return entry[1]
+
+    def __setitem__(self, key, value):
+        self.data[key] = (time.monotonic() + self.ttl, value)
+        self.data.move_to_end(key)
+        while len(self.data) > self.size:
+            self.data.popitem(last=False)
+            self.evictions += 1
+
+    def __delitem__(self, key):
+        del self.data[key]
+
+    def __len__(self):
+        return len(self.data)
+
+    def get(self, key, default=None):
+        entry = self._entry(key)
+        if entry is None:
+            self.misses += 1
+            return default
+        self.hits += 1
+        return entry[1]
+
+    def pop(self, key, default=None):
+        entry = self.data.pop(key, None)
+        if entry is None or entry[0] < time.monotonic():
+            return default
+        return entry[1]
+
+    def items(self):
+        """A snapshot of the live entries. Doesn't count as a use of them."""
+        now = time.monotonic()
+        return [(key, value) for key, (expires, value) in self.data.items() if expires >= now]
+
+    def stats(self):
+        return "{}/{} entries, {} hits, {} misses, {} evicted, {} expired".format(
+            len(self.data), self.size, self.hits, self.misses, self.evictions, self.expirations)
+
+
+class RatingTable:
+    """Ratings by steam_id and gametype, kept in an array column per gametype indexed
+    by a slot per steam_id, which takes a fraction of the memory of a dict per player.
+    Like LRUCache it holds at most size players, each for at most ttl seconds since
+    their last rating was set, and drops the least recently used to make room. Players
+    keep(steam_id) is true for are never dropped to make room; if there's nobody else,
+    the table grows past size instead."""
+    UNSET = -2 ** 31
+
+    def __init__(self, size, ttl, keep=lambda steam_id: False):
+        self.size = size
+        self.ttl = ttl
+        self.keep = keep
+        # Keys: steam_id - Items: slot, least recently used first
+        self.slots = collections.OrderedDict()
+        # Keys: gametype - Items: array of the rating in each slot
+        self.columns = {gametype: array("i") for gametype in ELO_GAMETYPES}
+        # time.monotonic() each slot expires at
+        self.expiry = array("d")
+        self.free = []
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def __len__(self):
+        return len(self.slots)
+
+    def _slot(self, steam_id):
+        slot = self.slots.get(steam_id)
+        if slot is None:
+            return None
+        if self.expiry[slot] < time.monotonic():
+            self._release(steam_id)
+            self.expirations += 1
+            return None
+        self.slots.move_to_end(steam_id)
+        return slot
+
+    def _release(self, steam_id):
+        slot = self.slots.pop(steam_id)
+        for column in self.columns.values():
+            column[slot] = RatingTable.UNSET
+        self.free.append(slot)
+
+    def _evict(self, count):
+        """Drops up to count of the least recently used players that aren't kept."""
+        victims = []
+        for steam_id in self.slots:
+            if len(victims) == count:
+                break
+            if not self.keep(steam_id):
+                victims.append(steam_id)
+        for steam_id in victims:
+            self._release(steam_id)
+        self.evictions += len(victims)
+
+    def _column(self, gametype):
+        if gametype not in self.columns:
+            self.columns[gametype] = array("i", [RatingTable.UNSET]) * len(self.expiry)
+        return self.columns[gametype]
+
+    def get(self, steam_id, gametype):
+        """The rating of steam_id for gametype, or None."""
+        slot = self._slot(steam_id)
+        if slot is not None and gametype in self.columns:
+            rating = self.columns[gametype][slot]
+            if rating != RatingTable.UNSET:
+                self.hits += 1
+                return rating
+        self.misses += 1
+        return None
+
+    def has(self, steam_id, gametype):
+        return self.get(steam_id, gametype) is not None
+
+    def set(self, steam_id, gametype, rating):
+        column = self._column(gametype)
+        slot = self._slot(steam_id)
+        if slot is None:
+            if len(self.slots) >= self.size:
+                self._evict(len(self.slots) - self.size + 1)
+            if self.free:
+                slot = self.free.pop()
+            else:
+                slot = len(self.expiry)
+                self.expiry.append(0)
+                for c in self.columns.values():
+                    c.append(RatingTable.UNSET)
+            self.slots[steam_id] = slot
+        column[slot] = rating
+        self.expiry[slot] = time.monotonic() + self.ttl
+
+    def remove(self, steam_id, gametype):
+        """Forgets the rating of steam_id for gametype. Returns whether there was one."""
+        slot = self._slot(steam_id)
+        if slot is None or gametype not in self.columns or self.columns[gametype][slot] == RatingTable.UNSET:
+            return False
+        self.columns[gametype][slot] = RatingTable.UNSET
+        if all(column[slot] == RatingTable.UNSET for column in self.columns.values()):
+            self._release(steam_id)
+        return True
+
+    def stats(self):
+        return "{}/{} entries, {} hits, {} misses, {} evicted, {} expired".format(
+            len(self.slots), self.size, self.hits, self.misses, self.evictions, self.expirations)
+
+
+class NickLookup:
+    """A nick looked up, or being looked up, for a player: their steam_id, the status
+    ("pending", "found" or "failed"), the uid of the DataGrabber doing it and, once
+    found, the {gametype: rating} it got."""
+    __slots__ = ("steam_id", "status", "uid", "ratings")
+
+    def __init__(self, steam_id, status, uid=None, ratings=None):
+        self.steam_id = steam_id
+        self.status = status
+        self.uid = uid
+        self.ratings = ratings
+
+
+class WriteBehind:
+    """Queues database writes and makes them from a background thread in pipelined
+    batches, so that they never hold up a server frame. Repeated writes to the same key
+    are merged and only the last one is made. Reads through mget() and hgetall() see
+    queued writes right away."""
+    def __init__(self, db, interval=WRITE_BEHIND_INTERVAL, batch_size=WRITE_BEHIND_BATCH):
+        self.db = db
+        self.interval = interval
+        self.batch_size = batch_size
+        self.lock = threading.Lock()
+        # Keys: key, or (key, field) of a hash - Items: (value, ttl), a value of None deletes
+        self.pending = collections.OrderedDict()
+        # The batch being written right now, still visible to reads until it's done.
+        self.flushing = {}
+        self.running = True
+        self.wakeup = threading.Event()
+        self.thread = threading.Thread(target=self.work, name="balance-writer", daemon=True)
+        self.thread.start()
+        atexit.register(self.stop)
+
+    def set(self, key, value, ttl=None):
+        with self.lock:
+            self.pending[key] = (value, ttl)
+            self.pending.move_to_end(key)
+
+    def delete(self, key):
+        self.set(key, None)
+
+    def hset(self, key, field, value):
+        self.set((key, field), value)
+
+    def hdel(self, key, field):
+        self.set((key, field), None)
+
+    def _queued(self):
+        """A copy of the queued writes as {key: (value, ttl)}, the latest one winning.
+        Reads take it before going to the database: a batch finishing in between is
+        then both in the copy and in the database, rather than in neither."""
+        with self.lock:
+            queued = dict(self.flushing)
+            queued.update(self.pending)
+        return queued
+
+    def mget(self, keys):
+        queued = self._queued()
+        values = self.db.mget(keys)
+        for i, key in enumerate(keys):
+            if key in queued:
+                values[i] = queued[key][0]
+        return values
+
+    def hgetall(self, keys):
+        """The fields of each hash in keys, read in one round trip."""
+        queued = self._queued()
+        pipe = self.db.pipeline(transaction=False)
+        for key in keys:
+            pipe.hgetall(key)
+        hashes = [dict(h or {}) for h in pipe.execute()]
+        wanted = {key: i for i, key in enumerate(keys)}
+        for entry, (value, ttl) in queued.items():
+            if isinstance(entry, tuple) and entry[0] in wanted:
+                fields = hashes[wanted[entry[0]]]
+                if value is None:
+                    fields.pop(entry[1], None)
+                else:
+                    fields[entry[1]] = value
+        return hashes
+
+    def flush(self):
+        while True:
+            with self.lock:
+                if not self.pending:
+                    return
+                count = min(self.batch_size, len(self.pending))
+                self.flushing = dict(self.pending.popitem(last=False) for _ in range(count))
+
+            pipe = self.db.pipeline()
+            for key, (value, ttl) in self.flushing.items():
+                if isinstance(key, tuple):
+                    if value is None:
+                        pipe.hdel(*key)
+                    else:
+                        pipe.hset(key[0], key[1], value)
+                elif value is None:
+                    pipe.delete(key)
+                elif ttl:
+                    pipe.setex(key, ttl, value)
+                else:
+                    pipe.set(key, value)
+            try:
+                pipe.execute()
+            except Exception:
+                # Put the batch back, unless a key has been written again since, and
+                # leave it for the next flush.
+                with self.lock:
+                    for key, entry in self.flushing.items():
+                        if key not in self.pending:
+                            self.pending[key] = entry
+                    self.flushing = {}
+                minqlx.log_exception()
+                return
+            with self.lock:
+                self.flushing = {}
+
+    def work(self):
+        while self.running:
+            self.wakeup.wait(self.interval)
+            self.wakeup.clear()
+            self.flush()
+
+    def stop(self):
+        """Stops the background thread and writes whatever is still queued."""
+        if not self.running:
+            return
+        self.running = False
+        self.wakeup.set()
+        self.thread.join(10)
+        self.flush()
+        atexit.unregister(self.stop)
+
+
+class CircuitBreaker:
+    """Keeps track of how QLRanks requests fare and stops sending them while it looks
+    down. After a backoff, a single probe request decides whether it's back."""
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.state = CircuitBreaker.CLOSED
+        # Outcome of the last CIRCUIT_WINDOW requests, True for success.
+        self.results = collections.deque(maxlen=CIRCUIT_WINDOW)
+        self.backoff = CIRCUIT_BACKOFF
+        self.opened_at = 0
+
+    def available(self):
+        """Whether a request could go out now, without claiming the probe."""
+        with self.lock:
+            return self.state == CircuitBreaker.CLOSED or (self.state == CircuitBreaker.OPEN and
+                time.monotonic() - self.opened_at >= self.backoff)
+
+    def allow(self):
+        """Whether a request may go out now. Once the backoff has passed, the first
+        caller gets to send the probe."""
+        with self.lock:
+            if self.state == CircuitBreaker.CLOSED:
+                return True
+            if self.state == CircuitBreaker.OPEN and time.monotonic() - self.opened_at >= self.backoff:
+                self.state = CircuitBreaker.HALF_OPEN
+                return True
+            return False
+
+    def record(self, success):
+        with self.lock:
+            if self.state == CircuitBreaker.HALF_OPEN:
+                if success:
+                    self.state = CircuitBreaker.CLOSED
+                    self.results.clear()
+                    self.backoff = CIRCUIT_BACKOFF
+                else:
+                    self.state = CircuitBreaker.OPEN
+                    self.opened_at = time.monotonic()
+                    self.backoff = min(self.backoff * 2, CIRCUIT_MAX_BACKOFF)
+                return
+
+            self.results.append(success)
+            failures = self.results.count(False)
+            if len(self.results) >= CIRCUIT_MIN_REQUESTS and failures / len(self.results) >= CIRCUIT_FAILURE_RATE:
+                self.state = CircuitBreaker.OPEN
+                self.opened_at = time.monotonic()
+
+    def stats(self):
+        with self.lock:
+            return "{}, {} of the last {} requests failed, backoff {}s".format(
+                self.state, self.results.count(False), len(self.results), self.backoff)
+
+
+class LookupPool:
+    """A fixed number of worker threads running DataGrabber lookups. Each worker keeps
+    its HTTP connections open between lookups, one per host."""
+    def __init__(self, workers=LOOKUP_WORKERS, queue_size=LOOKUP_QUEUE_SIZE):
+        self.jobs = queue.Queue(queue_size)
+        self.running = True
+        self.threads = []
+        for i in range(workers):
+            t = threading.Thread(target=self.work, name="balance-lookup-{}".format(i), daemon=True)
+            t.start()
+            self.threads.append(t)
+
+    def submit(self, job):
+        """Queues a job, returning False if the pool is stopped or too many are in flight."""
+        if not self.running:
+            return False
+        try:
+            self.jobs.put_nowait(job)
+            return True
+        except queue.Full:
+            return False
+
+    def stop(self):
+        self.running = False
+        try:
+            while True:
+                self.jobs.get_nowait()
+        except queue.Empty:
+            pass
+        for t in self.threads:
+            self.jobs.put(None)
+
+    def work(self):
+        connections = {}
+        while self.running:
+            job = self.jobs.get()
+            if job is None:
+                break
+            job.run(connections)
+        for c in connections.values():
+            c.close()
+
+
+class ProviderError(Exception):
+    """A rating provider couldn't answer. status ends up as DataGrabber().status."""
+    def __init__(self, message, status=-2):
+        super().__init__(message)
+        self.status = status
+
+
+class RatingProvider:
+    """Where lookups get ratings from. lookup() is called on a lookup worker with the
+    nicks to look up and the worker's keep-alive HTTP connections. It returns
+    {nick: {gametype: rating}} for the nicks it has any ratings for, or raises
+    ProviderError if it couldn't answer."""
+    name = "none"
+
+    def lookup(self, nicks, connections):
+        raise NotImplementedError()
+
+
+class HttpJsonProvider(RatingProvider):
+    """A QLRanks style API, answering GET path?nick=a+b with
+    {"players": [{"nick": "a", "ca": {"rank": 123, "elo": 1500}, ...}, ...]}."""
+    def __init__(self, host, path="/api.aspx?nick={}", timeout=10):
+        self.host = host
+        self.path = path
+        self.timeout = timeout
+        self.name = "http://{}{}".format(host, path)
+
+    def lookup(self, nicks, connections):
+        path = self.path.format("+".join(urllib.parse.quote(nick) for nick in nicks))
+        status, body = self.get_data(connections, path)
+        if status != http.client.OK: # 200
+            raise ProviderError("HTTP status {}.".format(status), status)
+        try:
+            data = json.loads(body.decode())
+        except ValueError:
+            raise ProviderError("Invalid JSON response.", -1)
+        if not isinstance(data, dict) or "players" not in data:
+            raise ProviderError("Valid, but unexpected JSON response.", -3)
+
+        result = {}
+        for qlName in data["players"]:
+            if not "nick" in qlName:
+                continue
+            ratings = {}
+            for gametype in ELO_GAMETYPES:
+                if qlName.get(gametype) and qlName[gametype]["rank"]:
+                    ratings[gametype] = qlName[gametype]["elo"]
+            if ratings:
+                result[qlName["nick"]] = ratings
+        return result
+
+    def get_data(self, connections, path, post_data=None, headers={}):
+        # A kept-alive connection may have been closed by the other end in the
+        # meantime, in which case we reconnect once and try again. Anything else,
+        # a timeout in particular, would only fail again, so it's raised right away.
+        while True:
+            reused = self.host in connections
+            if not reused:
+                connections[self.host] = http.client.HTTPConnection(self.host, timeout=self.timeout)
+            c = connections[self.host]
+            try:
+                if post_data:
+                    c.request("POST", path, post_data, headers)
+                else:
+                    c.request("GET", path, headers=headers)
+                response = c.getresponse()
+                return (response.status, response.read())
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                c.close()
+                del connections[self.host]
+                if not reused:
+                    raise
+            except (http.client.HTTPException, OSError):
+                c.close()
+                del connections[self.host]
+                raise
+
+
+class RedisProvider(RatingProvider):
+    """Ratings kept in our own database, one hash of gametype -> rating per nick."""
+    name = "redis"
+
+    def __init__(self, db):
+        self.db = db
+
+    def lookup(self, nicks, connections):
+        pipe = self.db.pipeline()
+        for nick in nicks:
+            pipe.hgetall(_provider_key.format(nick))
+        result = {}
+        for nick, ratings in zip(nicks, pipe.execute()):
+            ratings = {gt: int(r) for gt, r in ratings.items() if gt in ELO_GAMETYPES}
+            if ratings:
+                result[nick] = ratings
+        return result
+
+
+class FileProvider(RatingProvider):
+    """Ratings from a JSON file of nick -> {gametype: rating}, read again whenever
+    the file changes."""
+    def __init__(self, path):
+        self.path = os.path.expanduser(path)
+        self.name = "file " + self.path
+        self.lock = threading.Lock()
+        self.mtime = None
+        self.ratings = {}
+
+    def lookup(self, nicks, connections):
+        try:
+            mtime = os.path.getmtime(self.path)
+            with self.lock:
+                if mtime != self.mtime:
+                    with open(self.path) as f:
+                        self.ratings = json.load(f)
+                    self.mtime = mtime
+                ratings = self.ratings
+        except (OSError, ValueError) as e:
+            raise ProviderError("Can't read {}: {}".format(self.path, e))
+        return {nick: ratings[nick] for nick in nicks if ratings.get(nick)}
+
+
+class DataGrabber:
     instances = 0
 
-    def __init__(self, plugin, players):
-        threading.Thread.__init__(self)
+    def __init__(self, plugin, players, provider):
         self.uid = DataGrabber.instances
         self.plugin = plugin
         self.players = players
+        self.provider = provider
         self.status = 0
+        # time.monotonic() of when the lookup was created, picked up by a worker and answered.
+        self.created = time.monotonic()
+        self.started = None
+        self.fetched = None
         DataGrabber.instances += 1
-    
-    def run(self):
-        try:
-            try:
-                names = []
-                for player in self.players:
-                    names.append(self.players[player])
-                player_list = "+".join(names)
-                self.plugin.console("getting ranks for "+player_list)
-                data = self.get_data("www.qlranks.com", "/api.aspx?nick={}".format(player_list))
-            except:
-                self.status = -2
-                self.plugin.fetch_rating_datagrabber(None, self)
-                return
-
-            if "players" not in data:
-                raise Exception("QLRanks returned a valid, but unexpected JSON response.")
 
-            self.plugin.fetch_rating_datagrabber(data, self)
-            # Check for pending teams info/balancing needed. Execute if so.
-        except:
-            self.status = -3
-            e = traceback.format_exc().rstrip("\n")
-            #minqlx.debug("========== ERROR: QLRanks Fetcher #{} ==========".format(self.uid))
-            #for line in e.split("\n"):
-            #    minqlx.debug(line)
+    def start(self):
+        if not self.plugin.lookup_pool.submit(self):
+            self.status = -4
             self.plugin.fetch_rating_datagrabber(None, self)
     
-    def get_data(self, url, path, post_data=None, headers={}):
-        c = http.client.HTTPConnection(url, timeout=10)
-        if post_data:
-            c.request("POST", path, post_data, headers)
-        else:
-            c.request("GET", path, headers=headers)
-        response = c.getresponse()
-        self.status = response.status
-        
-        if response.status == http.client.OK: # 200
-            try:
-                data = json.loads(response.read().decode())
-                return data
-            except:
-                self.status = -1
-                return None
-        else:
-            return None
\ No newline at end of file
+    def run(self, connections):
+        self.started = time.monotonic()
+        circuit = self.plugin.circuit
+        if not circuit.allow():
+            self.status = -5
+            self.plugin.fetch_rating_datagrabber(None, self)
+            return
+
+        names = list(self.players.values())
+        ratings = None
+        if self.plugin.trace.enabled("lookup", TRACE_INFO):
+            self.plugin.trace("lookup", TRACE_INFO, "getting ranks for {} from {}", "+".join(names), self.provider.name)
+        try:
+            ratings = self.provider.lookup(names, connections)
+            self.status = 200
+        except ProviderError as e:
+            self.status = e.status
+            self.plugin.trace("lookup", TRACE_INFO, "lookup #{} failed: {}", self.uid, e)
+        except:
+            self.status = -2
+            self.plugin.trace("lookup", TRACE_INFO, "lookup #{} failed: {}", self.uid,
+                traceback.format_exc().rstrip("\n"))
+        self.fetched = time.monotonic()
+        circuit.record(self.status == 200)
+        self.plugin.fetch_rating_datagrabber(ratings, self)
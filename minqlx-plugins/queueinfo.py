@@ -103,7 +103,7 @@ class queueinfo(minqlx.Plugin):
             for name in queue:
                 self._plugin.try_set_notplaying(name)
                 if self._plugin.is_notplaying(name):
-                    pl = self._plugin.player(name)
+                    pl = self._plugin.find_player(name)
                     if pl is not None:
                         list.append(pl)
 
@@ -425,7 +425,7 @@ class queueinfo(minqlx.Plugin):
                     
                 channel.reply(reply)     
                 for name in notplaying:
-                    player_ = self.player(name)
+                    player_ = self.find_player(name)
                     if player_:
                         if "autoNotPlaying" in self.queue[name] and self.queue[name]["autoNotPlaying"]:                       
                             player_.tell("^7Due to a long waiting time, you have been automatically marked as NOT PLAYING.")
@@ -471,7 +471,24 @@ class queueinfo(minqlx.Plugin):
         else:
             return False
 
+    # balance keeps an index of the players on the server, so
+    # when it's loaded we look players up there instead of
+    # asking the server for each one of them.
+    def balance_roster(self):
+        if "balance" in self.plugins:
+            return getattr(self.plugins["balance"], "roster", None)
+        return None
+
+    def find_player(self, name):
+        roster = self.balance_roster()
+        if roster is not None:
+            return roster.player(name)
+        return self.player(name)
+
     def is_on_spec(self, name):
+        roster = self.balance_roster()
+        if roster is not None:
+            return roster.team_of(name) == "spectator"
         pl = self.player(name)
         if pl is not None:
             if pl.team == "spectator":
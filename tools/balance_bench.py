@@ -0,0 +1,377 @@
+# minqlbot - A Quake Live server administrator bot.
+# Copyright (C) 2015 Mino <mino@minomino.org>
+
+# This file is part of minqlbot.
+
+# minqlbot is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# minqlbot is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with minqlbot. If not, see <http://www.gnu.org/licenses/>.
+
+"""Benchmarks the balance plugin's team algorithms on made-up rosters, outside of a
+server. A small stand-in for the minqlx module provides the players, teams and
+database, so the plugin runs unmodified.
+
+For every team size and rating distribution it generates a number of rosters and
+reports, per algorithm, the mean and worst wall time, how many players it moved and
+the difference in average team rating it left behind.
+
+Examples:
+    python3 balance_bench.py
+    python3 balance_bench.py --sizes 4 8 12 --runs 50 --distributions normal bimodal
+    python3 balance_bench.py --json > before.json
+"""
+
+import argparse
+import importlib.util
+import json
+import os
+import random
+import re
+import statistics
+import sys
+import time
+import types
+
+GAMETYPE = "ca"
+DISTRIBUTIONS = {
+    "uniform": lambda rng: rng.uniform(800, 2400),
+    "normal": lambda rng: rng.gauss(1500, 250),
+    # A few strong regulars among mostly newer players.
+    "bimodal": lambda rng: rng.gauss(2000, 150) if rng.random() < 0.3 else rng.gauss(1200, 150),
+    "skewed": lambda rng: 800 + rng.expovariate(1 / 400),
+}
+
+
+class Player:
+    def __init__(self, server, steam_id, name, team):
+        self.server = server
+        self.steam_id = steam_id
+        self.name = name
+        self.clean_name = name
+        self.team = team
+
+    def __repr__(self):
+        return self.name
+
+    def __bool__(self):
+        return True
+
+    def tell(self, msg):
+        pass
+
+    def put(self, team):
+        self.server.move(self, team)
+
+    def update(self):
+        pass
+
+
+class Server:
+    """The players on the stand-in server and the team moves made on it."""
+    def __init__(self):
+        self.players = {}
+        self.plugin = None
+        self.moves = 0
+
+    def reset(self, red, blue):
+        self.players = {}
+        for i, rating in enumerate(red + blue):
+            steam_id = 76561198000000000 + i
+            team = "red" if i < len(red) else "blue"
+            self.players[steam_id] = (Player(self, steam_id, "p{}".format(i), team), round(rating))
+        self.moves = 0
+
+    def teams(self):
+        teams = {"red": [], "blue": [], "free": [], "spectator": []}
+        for player, rating in self.players.values():
+            teams[player.team].append(player)
+        return teams
+
+    def move(self, player, team):
+        old_team = player.team
+        player.team = team
+        self.moves += 1
+        if self.plugin:
+            self.plugin.handle_team_switch(player, old_team, team)
+
+    def average_difference(self):
+        sums = {"red": [], "blue": []}
+        for player, rating in self.players.values():
+            if player.team in sums:
+                sums[player.team].append(rating)
+        if not sums["red"] or not sums["blue"]:
+            return 0
+        return abs(statistics.mean(sums["red"]) - statistics.mean(sums["blue"]))
+
+
+class DB(dict):
+    """Just enough of the redis client for the plugin."""
+    def mget(self, keys):
+        return [self.get(key) for key in keys]
+
+    def pipeline(self, transaction=True):
+        return Pipeline(self)
+
+
+class Pipeline:
+    def __init__(self, db):
+        self.db = db
+        self.ops = []
+
+    def __getattr__(self, name):
+        return lambda *args: self.ops.append((name, args))
+
+    def execute(self):
+        results = []
+        for name, args in self.ops:
+            if name == "set":
+                self.db[args[0]] = str(args[1])
+            elif name == "setex":
+                self.db[args[0]] = str(args[2])
+            elif name == "delete":
+                self.db.pop(args[0], None)
+            results.append(self.db.get(args[0]) if name in ("get", "hgetall") else True)
+        return results
+
+
+class Channel:
+    def __init__(self):
+        self.replies = []
+
+    def reply(self, msg):
+        self.replies.append(msg)
+
+
+def install_minqlx(server):
+    """Puts a stand-in minqlx module in sys.modules. Delayed and next frame calls are
+    queued and run by run_frames(), threaded ones run right away."""
+    minqlx = types.ModuleType("minqlx")
+    minqlx.frames = []
+    minqlx.cvars = cvars = {}
+    database = DB()
+
+    def queued(function):
+        def wrapper(*args, **kwargs):
+            minqlx.frames.append((function, args, kwargs))
+        return wrapper
+
+    minqlx.delay = lambda seconds: queued
+    minqlx.next_frame = queued
+    minqlx.thread = lambda function: function
+    minqlx.log_exception = lambda *args: None
+    minqlx.clean_text = lambda text: re.sub(r"\^[0-9]", "", text)
+    minqlx.PRI_HIGH = 1
+    minqlx.RET_STOP_ALL = 2
+    minqlx.RET_USAGE = 3
+    minqlx.CHAT_CHANNEL = Channel()
+
+    class Plugin:
+        plugins = {}
+        db = database
+        game = types.SimpleNamespace(type_short=GAMETYPE, state="in_progress")
+
+        def add_hook(self, *args, **kwargs):
+            pass
+
+        def add_command(self, *args, **kwargs):
+            pass
+
+        def set_cvar_once(self, name, value):
+            cvars.setdefault(name, value)
+
+        def get_cvar(self, name, return_type=str):
+            value = cvars.get(name)
+            if value is None:
+                return None
+            if return_type is bool:
+                return bool(int(value))
+            return return_type(value)
+
+        def teams(self):
+            return server.teams()
+
+        def player(self, key):
+            entry = server.players.get(key)
+            return entry[0] if entry else None
+
+        def msg(self, msg):
+            pass
+
+        def console(self, msg):
+            pass
+
+        def switch(self, first, second):
+            first_team, second_team = first.team, second.team
+            server.move(first, second_team)
+            server.move(second, first_team)
+
+        def put(self, player, team):
+            server.move(player, team)
+
+        def lock(self, team):
+            pass
+
+        def unlock(self, team):
+            pass
+
+    minqlx.Plugin = Plugin
+    sys.modules["minqlx"] = minqlx
+    return minqlx
+
+
+def run_frames(minqlx):
+    while minqlx.frames:
+        function, args, kwargs = minqlx.frames.pop(0)
+        function(*args, **kwargs)
+
+
+def load_balance():
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "minqlx-plugins", "balance.py")
+    spec = importlib.util.spec_from_file_location("balance", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+class Bench:
+    def __init__(self, searchtime):
+        self.server = Server()
+        self.minqlx = install_minqlx(self.server)
+        self.minqlx.cvars["qlx_balance_searchtime"] = str(searchtime)
+        self.balance = load_balance()
+        self.plugin = self.balance.balance()
+        self.server.plugin = self.plugin
+        run_frames(self.minqlx)
+
+    def setup(self, red, blue):
+        """Puts a fresh roster on the server with all ratings known to the plugin."""
+        run_frames(self.minqlx)
+        self.server.reset(red, blue)
+        self.plugin._roster = None
+        self.plugin.team_ratings = None
+        for player, rating in self.server.players.values():
+            self.plugin.set_rating(player.steam_id, GAMETYPE, rating)
+        self.plugin.team_ratings_for(GAMETYPE)
+        self.server.moves = 0
+
+    def apply(self, switch):
+        reds, blues = switch
+        for player in reds:
+            self.server.move(player, "blue")
+        for player in blues:
+            self.server.move(player, "red")
+
+    def average_balance(self):
+        # The search hands its result back on the next frame, which applies it.
+        self.plugin.average_balance(Channel(), GAMETYPE)
+        run_frames(self.minqlx)
+
+    def suggest_switch(self):
+        suggestion = self.plugin.suggest_switch(self.plugin.roster.teams(), GAMETYPE)
+        return suggestion[0] if suggestion else None
+
+    def suggest_exchange(self):
+        suggestion = self.plugin.suggest_exchange(self.plugin.roster.teams(), GAMETYPE)
+        return suggestion[0] if suggestion else None
+
+    def team_average(self):
+        teams = self.plugin.roster.teams()
+        self.plugin.team_average(teams["red"], GAMETYPE)
+        self.plugin.team_average(teams["blue"], GAMETYPE)
+
+    def partition(self, solver):
+        players = [player for player, rating in self.server.players.values()]
+        ratings = [rating for player, rating in self.server.players.values()]
+        current = {i for i, p in enumerate(players) if p.team == "red"}
+        if solver == "partition_exact":
+            red_set, diff = self.balance.partition_exact(ratings)
+        else:
+            red_set, diff = self.balance.partition_heuristic(ratings, self.plugin.get_cvar("qlx_balance_searchtime", int) / 1000, current)
+        # Same labelling as best_partition(), moving as few players as possible.
+        other = set(range(len(players))) - red_set
+        if len(red_set ^ current) > len(other ^ current):
+            red_set = other
+        return ([p for i, p in enumerate(players) if p.team == "red" and i not in red_set],
+                [p for i, p in enumerate(players) if p.team == "blue" and i in red_set])
+
+    def measure(self, algorithm, red, blue):
+        """Runs algorithm on the roster and returns (seconds, players moved, average
+        difference afterwards, average difference before). Suggestions are applied as
+        if everyone agreed."""
+        self.setup(red, blue)
+        before = self.server.average_difference()
+        start = time.perf_counter()
+        if algorithm in ("partition_exact", "partition_heuristic"):
+            result = self.partition(algorithm)
+        else:
+            result = getattr(self, algorithm)()
+        elapsed = time.perf_counter() - start
+        if result:
+            self.apply(result)
+        return elapsed, self.server.moves, self.server.average_difference(), before
+
+
+ALGORITHMS = ("average_balance", "suggest_switch", "suggest_exchange", "team_average",
+              "partition_exact", "partition_heuristic")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the balance plugin's team algorithms.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=list(range(2, 13)), help="Players per team.")
+    parser.add_argument("--distributions", nargs="+", choices=sorted(DISTRIBUTIONS), default=sorted(DISTRIBUTIONS))
+    parser.add_argument("--algorithms", nargs="+", choices=ALGORITHMS, default=list(ALGORITHMS))
+    parser.add_argument("--runs", type=int, default=20, help="Rosters per size and distribution.")
+    parser.add_argument("--searchtime", type=int, default=5, help="qlx_balance_searchtime in milliseconds.")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", action="store_true", help="Print the results as JSON instead of a table.")
+    options = parser.parse_args()
+
+    bench = Bench(options.searchtime)
+    results = []
+    try:
+        for size in options.sizes:
+            for distribution in options.distributions:
+                rng = random.Random("{}-{}-{}".format(options.seed, size, distribution))
+                rosters = [([DISTRIBUTIONS[distribution](rng) for _ in range(size)],
+                            [DISTRIBUTIONS[distribution](rng) for _ in range(size)])
+                           for _ in range(options.runs)]
+                for algorithm in options.algorithms:
+                    if algorithm == "partition_exact" and 2 * size > bench.balance.EXACT_PARTITION_LIMIT:
+                        continue
+                    samples = [bench.measure(algorithm, red, blue) for red, blue in rosters]
+                    times = [s[0] * 1000 for s in samples]
+                    results.append({
+                        "size": size,
+                        "distribution": distribution,
+                        "algorithm": algorithm,
+                        "mean_ms": statistics.mean(times),
+                        "max_ms": max(times),
+                        "moves": statistics.mean(s[1] for s in samples),
+                        "before": statistics.mean(s[3] for s in samples),
+                        "after": statistics.mean(s[2] for s in samples),
+                    })
+    finally:
+        bench.plugin.lookup_pool.stop()
+        bench.plugin.writes.stop()
+
+    if options.json:
+        print(json.dumps(results, indent=2))
+        return
+
+    print("{:>4} {:<9} {:<20} {:>9} {:>9} {:>6} {:>8} {:>8}".format(
+        "size", "ratings", "algorithm", "mean ms", "max ms", "moves", "before", "after"))
+    for r in results:
+        print("{size:>4} {distribution:<9} {algorithm:<20} {mean_ms:>9.3f} {max_ms:>9.3f} {moves:>6.1f} {before:>8.1f} {after:>8.1f}".format(**r))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,139 @@
+# minqlbot - A Quake Live server administrator bot.
+# Copyright (C) 2015 Mino <mino@minomino.org>
+
+# This file is part of minqlbot.
+
+# minqlbot is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# minqlbot is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with minqlbot. If not, see <http://www.gnu.org/licenses/>.
+
+"""A local stand-in for the QLRanks API, for testing the balance plugin's lookups
+without the real thing. It answers GET /api.aspx?nick=a+b the way QLRanks did,
+with made-up but stable ratings, and can be told to be slow or to fail.
+
+Point the plugin at it with:
+    set qlx_balance_provider "http"
+    set qlx_balance_providerhost "127.0.0.1:8080"
+
+Examples:
+    python3 ratings_standin.py --port 8080
+    python3 ratings_standin.py --latency 300 --jitter 200 --error-rate 0.2
+    python3 ratings_standin.py --ratings ratings.json --unranked-rate 0.3
+"""
+
+import argparse
+import hashlib
+import http.server
+import json
+import random
+import time
+import urllib.parse
+
+GAMETYPES = ("ca", "ffa", "ctf", "duel", "tdm")
+
+
+class StandinHandler(http.server.BaseHTTPRequestHandler):
+    # Keep-alive, like the connections the plugin's lookup workers hold on to.
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        options = self.server.options
+        url = urllib.parse.urlsplit(self.path)
+        if url.path != "/api.aspx":
+            return self.reply(404, b"Not found")
+
+        delay = options.latency + random.uniform(0, options.jitter)
+        time.sleep(delay / 1000)
+
+        roll = random.random()
+        if roll < options.timeout_rate:
+            # Sit on the request until the client has long given up.
+            time.sleep(options.hang)
+            return self.reply(504, b"Gateway timeout")
+        roll -= options.timeout_rate
+        if roll < options.error_rate:
+            return self.reply(500, b"Internal server error")
+        roll -= options.error_rate
+        if roll < options.garbage_rate:
+            return self.reply(200, b"<html>not json</html>")
+
+        nicks = urllib.parse.parse_qs(url.query).get("nick", [""])[0].split(" ")
+        players = [self.server.player(nick) for nick in nicks if nick]
+        self.reply(200, json.dumps({"players": players}).encode())
+
+    def reply(self, status, body):
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        if not self.server.options.quiet:
+            super().log_message(format, *args)
+
+
+class StandinServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, options):
+        super().__init__(address, StandinHandler)
+        self.options = options
+        self.ratings = {}
+        if options.ratings:
+            with open(options.ratings) as f:
+                self.ratings = json.load(f)
+
+    def player(self, nick):
+        """A QLRanks player entry for nick. Nicks not in the ratings file get ratings
+        derived from a hash of the nick, so the same nick always gets the same ones."""
+        seed = int(hashlib.md5(nick.lower().encode()).hexdigest(), 16)
+        entry = {"nick": nick}
+        if nick in self.ratings:
+            ratings = self.ratings[nick]
+        elif (seed % 1000) / 1000 < self.options.unranked_rate:
+            ratings = {}
+        else:
+            ratings = {gt: 800 + (seed >> (i * 12)) % 1600 for i, gt in enumerate(GAMETYPES)}
+        for i, gt in enumerate(GAMETYPES):
+            if gt in ratings:
+                entry[gt] = {"rank": 1 + (seed >> (i * 7)) % 50000, "elo": int(ratings[gt])}
+            else:
+                entry[gt] = {"rank": 0, "elo": 0}
+        return entry
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local stand-in for the QLRanks API.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--ratings", help="JSON file of nick -> {gametype: rating} to serve.")
+    parser.add_argument("--latency", type=float, default=0, help="Milliseconds added to every response.")
+    parser.add_argument("--jitter", type=float, default=0, help="Up to this many more random milliseconds.")
+    parser.add_argument("--error-rate", type=float, default=0, help="Share of requests answered with a 500.")
+    parser.add_argument("--garbage-rate", type=float, default=0, help="Share of requests answered with invalid JSON.")
+    parser.add_argument("--timeout-rate", type=float, default=0, help="Share of requests left hanging for --hang seconds.")
+    parser.add_argument("--hang", type=float, default=30)
+    parser.add_argument("--unranked-rate", type=float, default=0, help="Share of unknown nicks that have no rating.")
+    parser.add_argument("--quiet", action="store_true")
+    options = parser.parse_args()
+
+    server = StandinServer((options.host, options.port), options)
+    print("Serving QLRanks stand-in on http://{}:{}/api.aspx".format(options.host, options.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()